@@ -1,15 +1,15 @@
+import multiprocessing
 import os
 import sys
-import tempfile
-import shutil
 import time
 from pathlib import Path
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-                            QPushButton, QProgressBar, QLabel, QFileDialog, QMessageBox)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QMimeData, QSize
-from PyQt6.QtGui import QDragEnterEvent, QDropEvent, QPalette, QColor, QIcon, QPixmap
+                            QPushButton, QProgressBar, QLabel, QFileDialog, QMessageBox, QSlider,
+                            QComboBox, QSpinBox, QCheckBox, QScrollArea)
+from PyQt6.QtCore import Qt, QThread, pyqtSignal, QMimeData, QSize, QTimer, QUrl
+from PyQt6.QtGui import QDragEnterEvent, QDropEvent, QPalette, QColor, QIcon, QPixmap, QImage
 from PyQt6.QtSvgWidgets import QSvgWidget
-import ffmpeg
+# seewav only imports numpy, Pillow and cairo once a file is previewed or rendered
 import seewav
 
 # Redirect stdout and stderr to prevent console requirements
@@ -36,121 +36,277 @@ log_path = os.path.join(os.path.expanduser("~"), "Documents", "seewav_log.txt")
 sys.stdout = StreamRedirector(log_path)
 sys.stderr = StreamRedirector(log_path)
 
+# Audio or video files seewav can take the audio from
+MEDIA_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.m4a', '.aac', '.mp4', '.mov', '.mkv', '.webm')
+
+# Style of the rendered videos, shared by the preview so that it shows the same result
+RENDER_SETTINGS = {
+    'fg_color': (1.0, 1.0, 1.0),  # Pure white color for waves
+    'fg_opacity': 1.0,  # Full opacity
+    'bg_color': (0.0, 0.2, 0.9),  # More vibrant blue background
+    # The numpy renderer does not need pycairo
+    'renderer': 'cairo' if seewav.has_cairo() else 'numpy',
+}
+# Video settings the user can pick, the first ones are the defaults
+RESOLUTIONS = {
+    '1080p (1920x1080)': (1920, 1080),  # Full HD
+    '720p (1280x720)': (1280, 720),
+    '480p (854x480)': (854, 480),
+    'Square (1080x1080)': (1080, 1080),
+    'Vertical (1080x1920)': (1080, 1920),
+}
+FRAME_RATES = (60, 30, 24)
+# Presets the auto mode picks from, from the best looking to the fastest to render
+AUTO_PRESETS = [
+    ('1080p (1920x1080)', 60),
+    ('1080p (1920x1080)', 30),
+    ('720p (1280x720)', 30),
+    ('480p (854x480)', 30),
+]
+# The preview is rendered at a quarter of the video resolution
+PREVIEW_SCALE = 0.25
+# Envelopes computed for the preview are reused by the full render
+CACHE_DIR = seewav.default_cache_dir()
+
 # Get absolute paths for resources
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 LOGO_PATH = os.path.join(SCRIPT_DIR, 'logo.png')
 SVG_PATH = os.path.join(SCRIPT_DIR, 'image.svg')
 
+# Status shown for each stage reported by seewav.visualize
+STAGE_LABELS = {
+    'analysis': "Analyzing audio...",
+    'frames': "Generating frames...",
+    'encode': "Creating final video...",
+    'mux': "Creating final video...",
+}
+
 class AudioProcessingThread(QThread):
     progress = pyqtSignal(int)
     error = pyqtSignal(str)
     finished = pyqtSignal(str)
-    frame_update = pyqtSignal(int, int, float)  # current frame, total frames, time left
+    stage_update = pyqtSignal(str, float, float, str, float)  # stage, done, total, unit, time left
     status_update = pyqtSignal(str)  # For status messages
+    cancelled = pyqtSignal(float)  # seconds it took to stop after the cancel request
 
-    def __init__(self, input_file, output_file):
+    def __init__(self, input_file, output_file, settings):
         super().__init__()
         self.input_file = input_file
         self.output_file = output_file
-        self.temp_dir = None
+        self.settings = settings  # size, rate, bars and profile
         self.start_time = 0
-        self.total_frames = 0
-        self.current_frame = 0
-        self.cancelled = False
+        # Kills the ffmpeg processes of the render right away
+        self.cancel_token = seewav.CancelToken()
 
     def cancel(self):
-        self.cancelled = True
+        self.cancel_token.cancel()
 
     def run(self):
         try:
             self.start_time = time.time()
-            # Create temporary directory
-            self.temp_dir = tempfile.mkdtemp()
-            
-            # Convert MP4 to MP3 if needed
-            input_path = Path(self.input_file)
-            if input_path.suffix.lower() == '.mp4':
-                self.status_update.emit("Converting MP4 to MP3...")
-                self.progress.emit(10)
-                temp_mp3 = os.path.join(self.temp_dir, 'temp.mp3')
-                try:
-                    ffmpeg.input(str(input_path)).output(temp_mp3).run(overwrite_output=True)
-                    self.input_file = temp_mp3
-                except ffmpeg.Error as e:
-                    self.error.emit(f"FFmpeg error: {str(e)}")
-                    return
-
-                if self.cancelled:
-                    return
-                    
-            self.progress.emit(30)
+            # seewav decodes the first audio stream of any container (MP3, WAV, MP4...)
+            # directly, no need to extract the audio first.
             self.status_update.emit("Analyzing audio...")
 
             # Process with seewav
             try:
-                # Create a progress callback function that emits signals
-                def update_progress(value):
-                    if value == 80:
-                        self.status_update.emit("Creating final video...")
-                    self.progress.emit(value)
-                
                 # Make sure all paths are Path objects
                 input_file_path = Path(self.input_file)
-                temp_dir_path = Path(self.temp_dir)
                 output_file_path = Path(self.output_file)
                 
-                # Get audio duration to estimate total frames
-                probe = ffmpeg.probe(str(input_file_path))
-                duration = float(probe['format']['duration'])
-                self.total_frames = int(duration * 60)  # 60 fps by default
+                # seewav reports each stage in its own unit (seconds of audio, frames), with
+                # the time left estimated from the measured speed of each stage.
+                def stage_callback(state):
+                    self.stage_update.emit(state['stage'], state['done'], state['total'],
+                                           state['unit'], state['eta'])
                 
-                # Create a frame tracking function
-                def frame_callback(frame_num, total_frames):
-                    if self.cancelled:
-                        raise InterruptedError("Processing cancelled by user")
-                        
-                    self.current_frame = frame_num
-                    elapsed_time = time.time() - self.start_time
-                    if frame_num > 0:
-                        time_per_frame = elapsed_time / frame_num
-                        frames_left = total_frames - frame_num
-                        time_left = frames_left * time_per_frame
-                    else:
-                        time_left = 0
-                    
-                    self.frame_update.emit(frame_num, total_frames, time_left)
-                
-                self.status_update.emit("Generating frames...")
                 seewav.visualize(
                     input_file_path,
-                    temp_dir_path,
+                    None,
                     output_file_path,
-                    rate=60,
-                    bars=50,
-                    fg_color=(1.0, 1.0, 1.0),  # Pure white color for waves
-                    fg_opacity=1.0,  # Full opacity
-                    bg_color=(0.0, 0.2, 0.9),  # More vibrant blue background
-                    size=(1920, 1080),  # Full HD
-                    progress_callback=update_progress,
-                    frame_callback=frame_callback
+                    cache_dir=CACHE_DIR,
+                    progress_callback=self.progress.emit,
+                    stage_callback=stage_callback,
+                    cancel=self.cancel_token,
+                    **RENDER_SETTINGS,
+                    **self.settings
                 )
                 self.progress.emit(100)
                 self.finished.emit(self.output_file)
-            except InterruptedError:
-                self.status_update.emit("Processing cancelled")
+            except seewav.Cancelled:
+                self.cancelled.emit(self.cancel_token.latency or 0.)
                 return
             except Exception as e:
                 self.error.emit(f"SeeWave error: {str(e)}")
 
         except Exception as e:
             self.error.emit(str(e))
-        finally:
-            # Cleanup temp directory
-            if self.temp_dir and os.path.exists(self.temp_dir):
-                try:
-                    shutil.rmtree(self.temp_dir)
-                except Exception as e:
-                    print(f"Error cleaning up temp directory: {e}")
+
+class CalibrationThread(QThread):
+    calibrated = pyqtSignal(str, object)  # encoder profile, result of seewav.calibrate
+    error = pyqtSignal(str)
+
+    def __init__(self, profile):
+        super().__init__()
+        self.profile = profile
+
+    def run(self):
+        try:
+            # Cached on disk, only the first start on this machine and version renders
+            calibration = seewav.calibrate(self.profile, renderer=RENDER_SETTINGS['renderer'],
+                                           cache_dir=CACHE_DIR)
+        except Exception as e:
+            self.error.emit(f"Could not estimate render times: {str(e)}")
+        else:
+            self.calibrated.emit(self.profile, calibration)
+
+class PreviewLoader(QThread):
+    planned = pyqtSignal(str, object)  # input file, duration in seconds or None
+    loaded = pyqtSignal(str, object)  # input file, seewav.FramePreview
+    error = pyqtSignal(str)
+
+    def __init__(self, input_file, settings):
+        super().__init__()
+        self.input_file = input_file
+        self.settings = settings
+
+    def run(self):
+        # Probing the file runs ffprobe, which must not block the UI thread
+        try:
+            duration = seewav.render_plan(self.input_file, cache_dir=CACHE_DIR)['duration']
+        except Exception as e:
+            duration = None
+            print(f"Could not read the duration of {self.input_file}: {e}")
+        self.planned.emit(self.input_file, duration)
+        try:
+            preview = seewav.FramePreview(self.input_file, scale=PREVIEW_SCALE,
+                                          cache_dir=CACHE_DIR, size=self.settings['size'],
+                                          rate=self.settings['rate'], bars=self.settings['bars'],
+                                          **RENDER_SETTINGS)
+        except Exception as e:
+            self.error.emit(f"Preview error: {str(e)}")
+        else:
+            self.loaded.emit(self.input_file, preview)
+
+def import_multimedia():
+    """QtMultimedia loads the media backends, which is slow, so it is only imported for the first preview."""
+    try:
+        from PyQt6 import QtMultimedia
+    except ImportError:
+        # The preview still works without playback, using the slider only.
+        return None
+    return QtMultimedia
+
+class PreviewPane(QWidget):
+    """Shows the frame of the video at the playback or slider position, nothing is encoded."""
+
+    def __init__(self):
+        super().__init__()
+        self.preview = None
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.image_label = QLabel("Loading preview...")
+        self.image_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.image_label.setFixedSize(480, 270)
+        layout.addWidget(self.image_label, 0, Qt.AlignmentFlag.AlignCenter)
+
+        controls = QHBoxLayout()
+        self.play_btn = QPushButton("Play")
+        self.play_btn.clicked.connect(self.toggle_playback)
+        controls.addWidget(self.play_btn)
+        self.slider = QSlider(Qt.Orientation.Horizontal)
+        self.slider.valueChanged.connect(self.on_slider_changed)
+        controls.addWidget(self.slider)
+        self.time_label = QLabel("0:00")
+        controls.addWidget(self.time_label)
+        layout.addLayout(controls)
+        self.setLayout(layout)
+
+        # Created with the first preview, see create_player
+        self.player_created = False
+        self.multimedia = None
+        self.player = None
+        # Follow the playback position at the frame rate of the preview
+        self.timer = QTimer(self)
+        self.timer.setInterval(33)
+        self.timer.timeout.connect(self.on_tick)
+
+    def clear(self):
+        self.stop()
+        self.preview = None
+        self.image_label.setPixmap(QPixmap())
+        self.image_label.setText("Loading preview...")
+        self.setEnabled(False)
+
+    def create_player(self):
+        self.player_created = True
+        self.multimedia = import_multimedia()
+        if self.multimedia is None:
+            self.play_btn.setEnabled(False)
+            return
+        self.player = self.multimedia.QMediaPlayer()
+        self.audio_output = self.multimedia.QAudioOutput()
+        self.player.setAudioOutput(self.audio_output)
+
+    def set_preview(self, input_file, preview):
+        if not self.player_created:
+            self.create_player()
+        self.stop()
+        self.preview = preview
+        self.image_label.setFixedSize(*preview.size)
+        if self.player is not None:
+            self.player.setSource(QUrl.fromLocalFile(input_file))
+        self.slider.blockSignals(True)
+        self.slider.setRange(0, max(0, preview.frames - 1))
+        self.slider.setValue(0)
+        self.slider.blockSignals(False)
+        self.setEnabled(True)
+        self.show_position(0.)
+
+    def show_position(self, position):
+        if self.preview is None:
+            return
+        data = bytes(self.preview.render(position))
+        width, height = self.preview.size
+        # seewav frames are premultiplied BGRA, which is ARGB32 in native (little endian) order
+        image = QImage(data, width, height, 4 * width, QImage.Format.Format_ARGB32_Premultiplied)
+        self.image_label.setPixmap(QPixmap.fromImage(image.copy()))
+        self.time_label.setText(f"{int(position // 60)}:{int(position % 60):02d}")
+
+    def on_slider_changed(self, frame):
+        if self.preview is None:
+            return
+        position = frame / self.preview.rate
+        if self.player is not None:
+            self.player.setPosition(int(position * 1000))
+        self.show_position(position)
+
+    def on_tick(self):
+        if self.player.playbackState() != self.multimedia.QMediaPlayer.PlaybackState.PlayingState:
+            self.stop()
+            return
+        position = self.player.position() / 1000
+        self.slider.blockSignals(True)
+        self.slider.setValue(int(position * self.preview.rate))
+        self.slider.blockSignals(False)
+        self.show_position(position)
+
+    def toggle_playback(self):
+        if self.player is None or self.preview is None:
+            return
+        if self.timer.isActive():
+            self.stop()
+        else:
+            self.player.play()
+            self.timer.start()
+            self.play_btn.setText("Pause")
+
+    def stop(self):
+        self.timer.stop()
+        if self.player is not None:
+            self.player.pause()
+        self.play_btn.setText("Play")
 
 class DropArea(QWidget):
     fileDropped = pyqtSignal(str)
@@ -159,7 +315,7 @@ class DropArea(QWidget):
         super().__init__()
         self.setAcceptDrops(True)
         layout = QVBoxLayout()
-        self.label = QLabel("Drag & Drop\nMP3, MP4, or WAV file here\nor click to select")
+        self.label = QLabel("Drag & Drop\naudio or video file here\nor click to select")
         self.label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         layout.addWidget(self.label)
         self.setLayout(layout)
@@ -180,7 +336,7 @@ class DropArea(QWidget):
     def dropEvent(self, event: QDropEvent):
         for url in event.mimeData().urls():
             file_path = url.toLocalFile()
-            if file_path.lower().endswith(('.mp3', '.mp4', '.wav')):
+            if file_path.lower().endswith(MEDIA_EXTENSIONS):
                 self.fileDropped.emit(file_path)
                 break
 
@@ -189,7 +345,7 @@ class DropArea(QWidget):
             self,
             "Select Audio/Video File",
             "",
-            "Audio/Video Files (*.mp3 *.mp4 *.wav)"
+            "Audio/Video Files (" + " ".join("*" + ext for ext in MEDIA_EXTENSIONS) + ")"
         )
         if file_path:
             self.fileDropped.emit(file_path)
@@ -199,12 +355,23 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.initUI()
         self.processing_thread = None
+        self.preview_loaders = []
         self.selected_input_file = None
         self.selected_output_file = None
+        self.audio_duration = None
+        self.preview_settings = None
+        # Measured cost of the frames for each encoder profile, see seewav.calibrate
+        self.calibrations = {}
+        self.calibration_threads = []
+        self.start_calibration(self.profile_combo.currentText())
 
     def initUI(self):
         self.setWindowTitle('SeeWave Generator')
         self.setMinimumSize(700, 550)  # Increased window size
+        # Opens with room for the preview when the screen allows it, the content scrolls otherwise
+        screen = QApplication.primaryScreen()
+        height = 900 if screen is None else min(900, screen.availableGeometry().height())
+        self.resize(700, max(550, height))
         
         # Set app icon
         if os.path.exists(LOGO_PATH):
@@ -247,11 +414,19 @@ class MainWindow(QMainWindow):
                 background-color: #10B981;
                 border-radius: 3px;
             }
+            QScrollArea, QScrollArea > QWidget > QWidget {
+                background: transparent;
+                border: none;
+            }
         """)
 
-        # Central widget
+        # Central widget, in a scroll area for the windows smaller than the content with
+        # the preview shown
         central_widget = QWidget()
-        self.setCentralWidget(central_widget)
+        scroll_area = QScrollArea()
+        scroll_area.setWidgetResizable(True)
+        scroll_area.setWidget(central_widget)
+        self.setCentralWidget(scroll_area)
         layout = QVBoxLayout(central_widget)
         
         # Header with SVG image and title
@@ -290,6 +465,44 @@ class MainWindow(QMainWindow):
         self.file_info_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.file_info_label.setStyleSheet("color: #10B981; margin-top: 10px;")
         layout.addWidget(self.file_info_label)
+
+        # Live preview of the selected file
+        self.preview_pane = PreviewPane()
+        self.preview_pane.setVisible(False)
+        layout.addWidget(self.preview_pane)
+
+        # Video settings
+        settings_layout = QHBoxLayout()
+        self.auto_check = QCheckBox("Auto")
+        self.auto_check.setToolTip("Pick the best resolution and frame rate this computer renders in real time")
+        self.auto_check.toggled.connect(self.on_auto_toggled)
+        settings_layout.addWidget(self.auto_check)
+        self.resolution_combo = QComboBox()
+        self.resolution_combo.addItems(list(RESOLUTIONS))
+        self.resolution_combo.currentIndexChanged.connect(self.on_settings_changed)
+        settings_layout.addWidget(self.resolution_combo)
+        self.rate_combo = QComboBox()
+        self.rate_combo.addItems([f"{rate} fps" for rate in FRAME_RATES])
+        self.rate_combo.currentIndexChanged.connect(self.on_settings_changed)
+        settings_layout.addWidget(self.rate_combo)
+        settings_layout.addWidget(QLabel("Bars:"))
+        self.bars_spin = QSpinBox()
+        self.bars_spin.setRange(10, 200)
+        self.bars_spin.setValue(50)
+        self.bars_spin.valueChanged.connect(self.on_settings_changed)
+        settings_layout.addWidget(self.bars_spin)
+        settings_layout.addWidget(QLabel("Quality:"))
+        self.profile_combo = QComboBox()
+        self.profile_combo.addItems(list(seewav.ENCODER_PROFILES))
+        self.profile_combo.currentIndexChanged.connect(self.on_profile_changed)
+        settings_layout.addWidget(self.profile_combo)
+        layout.addLayout(settings_layout)
+
+        # Render time estimates, from a short calibration render
+        self.estimate_label = QLabel("Measuring render speed...")
+        self.estimate_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.estimate_label.setStyleSheet("color: #A3B1CC;")
+        layout.addWidget(self.estimate_label)
         
         # Action buttons
         button_layout = QHBoxLayout()
@@ -392,6 +605,120 @@ class MainWindow(QMainWindow):
         # Enable the start button since we have both input and output
         self.start_btn.setEnabled(True)
 
+        # The duration is read by the preview loader, see on_duration_read
+        self.audio_duration = None
+        self.update_estimate()
+        self.load_preview()
+
+    def load_preview(self):
+        # Analyze the audio in the background for the preview
+        settings = self.current_settings()
+        self.preview_settings = settings
+        self.preview_pane.clear()
+        self.preview_pane.setVisible(True)
+        # Loaders of previously selected files are kept until they finish, as a running
+        # QThread must not be garbage collected.
+        self.preview_loaders = [loader for loader in self.preview_loaders if loader.isRunning()]
+        preview_loader = PreviewLoader(self.selected_input_file, settings)
+        preview_loader.planned.connect(self.on_duration_read)
+        preview_loader.loaded.connect(self.on_preview_loaded)
+        preview_loader.error.connect(self.update_status)
+        preview_loader.start()
+        self.preview_loaders.append(preview_loader)
+
+    def on_duration_read(self, input_file, duration):
+        if input_file != self.selected_input_file:
+            return
+        self.audio_duration = duration
+        if duration is None:
+            self.estimate_label.setText("Could not read the duration of the file")
+        else:
+            self.update_estimate()
+
+    def on_preview_loaded(self, input_file, preview):
+        # Ignore previews of a file or settings that are not selected anymore
+        if input_file == self.selected_input_file and not self.preview_outdated():
+            self.preview_pane.set_preview(input_file, preview)
+
+    def preview_outdated(self):
+        # The encoder profile does not change the preview
+        settings = self.current_settings()
+        return any(self.preview_settings[key] != settings[key] for key in ('size', 'rate', 'bars'))
+
+    def current_settings(self):
+        return {
+            'size': RESOLUTIONS[self.resolution_combo.currentText()],
+            'rate': FRAME_RATES[self.rate_combo.currentIndex()],
+            'bars': self.bars_spin.value(),
+            'profile': self.profile_combo.currentText(),
+        }
+
+    def on_settings_changed(self):
+        self.update_estimate()
+        if self.selected_input_file is not None and self.preview_settings is not None \
+                and self.preview_outdated():
+            self.load_preview()
+
+    def on_profile_changed(self):
+        self.start_calibration(self.profile_combo.currentText())
+        self.on_settings_changed()
+
+    def on_auto_toggled(self, checked):
+        self.resolution_combo.setEnabled(not checked)
+        self.rate_combo.setEnabled(not checked)
+        self.on_settings_changed()
+
+    def start_calibration(self, profile):
+        if profile in self.calibrations:
+            return
+        if any(thread.profile == profile and thread.isRunning() for thread in self.calibration_threads):
+            return
+        # Finished threads can be released, running ones must be kept referenced.
+        self.calibration_threads = [thread for thread in self.calibration_threads if thread.isRunning()]
+        thread = CalibrationThread(profile)
+        thread.calibrated.connect(self.on_calibrated)
+        thread.error.connect(self.estimate_label.setText)
+        thread.start()
+        self.calibration_threads.append(thread)
+
+    def on_calibrated(self, profile, calibration):
+        self.calibrations[profile] = calibration
+        self.update_estimate()
+
+    def update_estimate(self):
+        calibration = self.calibrations.get(self.profile_combo.currentText())
+        if calibration is None:
+            self.estimate_label.setText("Measuring render speed...")
+            return
+        if self.audio_duration is None:
+            if self.selected_input_file is None:
+                self.estimate_label.setText("Select a file to estimate the render time")
+            else:
+                self.estimate_label.setText("Reading the file...")
+            return
+
+        def estimate(resolution, rate):
+            return seewav.estimate_render_time(calibration, self.audio_duration, rate, RESOLUTIONS[resolution],
+                                               self.bars_spin.value())
+
+        if self.auto_check.isChecked():
+            # Best preset rendering in real time, or the fastest one (the last)
+            for resolution, rate in AUTO_PRESETS:
+                if estimate(resolution, rate) <= self.audio_duration:
+                    break
+            for combo, value in [(self.resolution_combo, resolution), (self.rate_combo, f"{rate} fps")]:
+                combo.blockSignals(True)
+                combo.setCurrentText(value)
+                combo.blockSignals(False)
+            if self.selected_input_file is not None and self.preview_settings is not None \
+                    and self.preview_outdated():
+                self.load_preview()
+
+        current = estimate(self.resolution_combo.currentText(), self.current_settings()['rate'])
+        presets = "  ".join(f"{resolution.split()[0]} {rate} fps: {format_duration(estimate(resolution, rate))}"
+                            for resolution, rate in AUTO_PRESETS)
+        self.estimate_label.setText(f"Estimated render time: {format_duration(current)}\n{presets}")
+
     def select_output_location(self):
         if not self.selected_input_file:
             return
@@ -426,33 +753,41 @@ class MainWindow(QMainWindow):
         self.output_location_btn.setEnabled(False)
         self.start_btn.setEnabled(False)
         self.cancel_btn.setEnabled(True)
+        self.set_settings_enabled(False)
         self.status_label.setText("Initializing...")
+        self.preview_pane.stop()
 
         # Start processing thread
-        self.processing_thread = AudioProcessingThread(self.selected_input_file, self.selected_output_file)
+        self.processing_thread = AudioProcessingThread(self.selected_input_file, self.selected_output_file,
+                                                       self.current_settings())
         self.processing_thread.progress.connect(self.update_progress)
         self.processing_thread.error.connect(self.handle_error)
         self.processing_thread.finished.connect(self.handle_completion)
-        self.processing_thread.frame_update.connect(self.update_frame_status)
+        self.processing_thread.stage_update.connect(self.update_stage_status)
         self.processing_thread.status_update.connect(self.update_status)
+        self.processing_thread.cancelled.connect(self.handle_cancelled)
         self.processing_thread.start()
 
     def cancel_processing(self):
         if self.processing_thread and self.processing_thread.isRunning():
             self.status_label.setText("Cancelling...")
+            self.cancel_btn.setEnabled(False)
+            # The UI is reset by handle_cancelled once the render actually stopped
             self.processing_thread.cancel()
-            # Reset UI after a short delay
-            QApplication.processEvents()
-            self.reset_ui()
+
+    def handle_cancelled(self, latency):
+        self.reset_ui()
+        self.status_label.setText(f"Processing cancelled (stopped in {latency:.2f}s)")
 
     def update_progress(self, value):
         self.progress_bar.setValue(value)
         QApplication.processEvents()  # Force UI update
         
-    def update_frame_status(self, current_frame, total_frames, time_left):
+    def update_stage_status(self, stage, done, total, unit, time_left):
         minutes = int(time_left / 60)
         seconds = int(time_left % 60)
-        self.status_label.setText(f"Processing {current_frame}/{total_frames} frames\nTime remaining: {minutes}m {seconds}s")
+        self.status_label.setText(f"{STAGE_LABELS.get(stage, 'Processing...')} {int(done)}/{int(total)} {unit}\n"
+                                  f"Time remaining: {minutes}m {seconds}s")
         QApplication.processEvents()  # Force UI update
         
     def update_status(self, status):
@@ -484,8 +819,20 @@ class MainWindow(QMainWindow):
         self.output_location_btn.setEnabled(self.selected_input_file is not None)
         self.start_btn.setEnabled(self.selected_input_file is not None and self.selected_output_file is not None)
         self.cancel_btn.setEnabled(False)
+        self.set_settings_enabled(True)
         self.status_label.setText("")
 
+    def set_settings_enabled(self, enabled):
+        self.auto_check.setEnabled(enabled)
+        self.resolution_combo.setEnabled(enabled and not self.auto_check.isChecked())
+        self.rate_combo.setEnabled(enabled and not self.auto_check.isChecked())
+        self.bars_spin.setEnabled(enabled)
+        self.profile_combo.setEnabled(enabled)
+
+def format_duration(seconds):
+    minutes = int(seconds / 60)
+    return f"~{minutes}m {int(seconds % 60)}s" if minutes else f"~{int(seconds)}s"
+
 def main():
     try:
         app = QApplication(sys.argv)
@@ -538,4 +885,6 @@ def main():
         sys.exit(1)
 
 if __name__ == '__main__':
+    # Required for the frame rendering process pool in the frozen executable.
+    multiprocessing.freeze_support()
     main() 
\ No newline at end of file
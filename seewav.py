@@ -1,16 +1,84 @@
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import errno
+import functools
+import hashlib
+import http.server
+import importlib
+import importlib.util
+import itertools
 import json
 import math
+import multiprocessing
+import os
+import queue
+import signal
+import socketserver
 import subprocess as sp
 import sys
 import tempfile
+import threading
+import time
 import platform
+import shutil
+import uuid
+import wave
 from pathlib import Path
+from time import perf_counter
 
-import cairo
-import PIL.Image as Image
-import numpy as np
-import tqdm
+
+class _LazyModule:
+    """
+    Internal, stands for the module `name` until one of its attributes is used. The module
+    is then imported and replaces this placeholder in the globals of seewav, under `alias`
+    (like `import name as alias`) or the top level package name (like `import name`).
+    """
+
+    def __init__(self, name, alias=None):
+        self._name = name
+        self._alias = alias
+
+    def _load(self):
+        module = importlib.import_module(self._name)
+        if self._alias is None:
+            alias = self._name.partition('.')[0]
+            module = sys.modules[alias]
+        else:
+            alias = self._alias
+        globals()[alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def _preload(*modules):
+    """
+    Internal function, import right away the `modules` that are still `_LazyModule`.
+    """
+    for module in modules:
+        if isinstance(module, _LazyModule):
+            module._load()
+
+
+# Heavy modules are only imported by the code paths needing them, so that the command
+# line help, probing files or opening the GUI do not wait for numpy, Pillow and such.
+# They must be listed in the hidden imports of seewav.spec.
+np = _LazyModule('numpy', 'np')
+Image = _LazyModule('PIL.Image', 'Image')
+tqdm = _LazyModule('tqdm')
+# Only required by the cairo renderer, see `NumpyRenderer` and `has_cairo`.
+cairo = _LazyModule('cairo')
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, only used to report the peak memory in `bench`.
+    resource = None
 
 _is_main = False
 
@@ -22,6 +90,25 @@ else:
     CREATE_NO_WINDOW = 0  # Dummy value for non-Windows systems
 
 
+def _subprocess_args():
+    """
+    Internal function, extra keyword arguments of `subprocess` calls, so that ffmpeg and
+    ffprobe do not open a console window on Windows.
+    """
+    if platform.system() == 'Windows':
+        return {'creationflags': CREATE_NO_WINDOW}
+    return {}
+
+
+def _spawn_context():
+    """
+    Internal function, the `multiprocessing` context of every pool: spawn rather than fork,
+    as we might be called from a thread (e.g. the GUI), and so that workers do not inherit
+    the memory of this process.
+    """
+    return multiprocessing.get_context('spawn')
+
+
 def colorize(text, color):
     """
     Wrap `text` with ANSI `color` code. See
@@ -45,143 +132,1728 @@ def fatal(msg):
         sys.exit(1)
 
 
-def read_info(media):
+class Cancelled(Exception):
+    """
+    Raised by a render that was cancelled with its `CancelToken`.
+    """
+
+
+class CancelToken:
+    """
+    Lets another thread (e.g. a GUI or a server) interrupt a render, see `visualize`.
+    `cancel` kills right away the ffmpeg processes registered with `watch`, the render
+    then raises `Cancelled` from the next `check`. The time between both is kept in
+    `latency`.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.cancelled_at = None
+        self.latency = None
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.cancelled_at = time.monotonic()
+            processes = list(self._processes)
+        for proc in processes:
+            _kill(proc)
+
+    def check(self):
+        """
+        Raise `Cancelled` if the token was cancelled.
+        """
+        if self.cancelled:
+            if self.latency is None:
+                self.latency = time.monotonic() - self.cancelled_at
+            raise Cancelled(f"cancelled after {self.latency:.3f}s")
+
+    @contextlib.contextmanager
+    def watch(self, proc):
+        """
+        Kill the process `proc` if the token is cancelled while in this context.
+        """
+        with self._lock:
+            self._processes.add(proc)
+            cancelled = self.cancelled
+        if cancelled:
+            _kill(proc)
+        try:
+            yield proc
+        finally:
+            with self._lock:
+                self._processes.discard(proc)
+
+
+def _kill(proc):
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+
+def _with_progress(command):
+    """
+    Internal function, add the options making the ffmpeg `command` write its progress to
+    stdout, see `_parse_progress`.
+    """
+    return command[:1] + ["-nostats", "-progress", "pipe:1"] + command[1:]
+
+
+def _parse_progress(stream, on_progress):
+    """
+    Internal function, read the `key=value` lines written by ffmpeg `-progress` to
+    `stream` until it is closed, and call `on_progress` with a dict of each block of
+    values (e.g. `frame` or `out_time_us`, as strings).
+    """
+    block = {}
+    for line in stream:
+        key, sep, value = line.decode('utf-8', 'replace').strip().partition('=')
+        if not sep:
+            continue
+        block[key] = value
+        if key == 'progress':
+            on_progress(block)
+            block = {}
+
+
+def _progress_seconds(block):
+    """
+    Internal function, position in seconds of the output in an ffmpeg progress `block`.
+    """
+    try:
+        return max(0., int(block.get('out_time_us', '')) / 1e6)
+    except ValueError:
+        return 0.
+
+
+def _run_process(command, cancel=None, capture=False, on_progress=None):
+    """
+    Internal function, same as `sp.run(command, check=True)`, except the process is killed
+    as soon as the `CancelToken` `cancel` is cancelled. Returns the stdout if `capture`.
+    For ffmpeg commands, `on_progress` (if not None and not `capture`) is called with each
+    block of progress values reported by ffmpeg, see `_parse_progress`.
+    """
+    if cancel is None:
+        cancel = CancelToken()
+    if capture:
+        on_progress = None
+    if on_progress is not None:
+        command = _with_progress(command)
+    proc = sp.Popen(command, stdout=sp.PIPE if capture or on_progress else None,
+                    stderr=sp.PIPE if capture else None, **_subprocess_args())
+    with cancel.watch(proc):
+        try:
+            if on_progress is not None:
+                _parse_progress(proc.stdout, on_progress)
+                proc.wait()
+                stdout = None
+            else:
+                stdout, _ = proc.communicate()
+        except BaseException:
+            _kill(proc)
+            proc.wait()
+            raise
+    cancel.check()
+    if proc.returncode:
+        raise sp.CalledProcessError(proc.returncode, command)
+    return stdout
+
+
+# In memory cache of `read_info`, keyed by path, modification time and size, holding the
+# `_INFO_CACHE_SIZE` most recently used files (a server probes an unbounded number of them).
+_INFO_CACHE_SIZE = 256
+_info_cache = collections.OrderedDict()
+_info_lock = threading.Lock()
+
+
+def _cached_info(key, info=None):
+    """
+    Internal function, store `info` in `_info_cache` if not None, otherwise return the info
+    stored for `key`, or None. Either way `key` becomes the most recently used entry.
+    """
+    with _info_lock:
+        if info is None:
+            info = _info_cache.get(key)
+            if info is not None:
+                _info_cache.move_to_end(key)
+            return info
+        _info_cache[key] = info
+        _info_cache.move_to_end(key)
+        while len(_info_cache) > _INFO_CACHE_SIZE:
+            _info_cache.popitem(last=False)
+        return info
+
+
+def read_info(media, cache_dir=None):
     """
     Return some info on the media file.
+    Results are cached in memory, and on disk in `cache_dir` if not None, keyed by the
+    path, modification time and size of the file, so that it is only probed once.
+    """
+    try:
+        stat = os.stat(media)
+    except OSError:
+        raise IOError(f"{media} does not exist or is of a wrong type.")
+    key = (os.path.abspath(media), stat.st_mtime_ns, stat.st_size)
+    stored = None
+    if cache_dir is not None:
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        stored = Path(cache_dir) / 'probes' / f"{digest}.json"
+    info = _cached_info(key)
+    if info is None and stored is not None:
+        try:
+            with open(stored, encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            pass
+        else:
+            # Refresh the access time used for the LRU eviction, see `_evict`.
+            with contextlib.suppress(OSError):
+                os.utime(stored)
+            return _cached_info(key, info)
+    if info is None:
+        info = _cached_info(key, _probe(media))
+    if stored is not None and not stored.exists():
+        try:
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = stored.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(info, f)
+            os.replace(tmp_path, stored)
+        except OSError as err:
+            print(f"Warning: could not write to the probe cache: {err}", file=sys.stderr)
+    return info
+
+
+def _probe(media):
+    """
+    Internal function, run ffprobe on the `media` file.
     """
-    # Set subprocess flags based on platform
-    extra_args = {}
-    if platform.system() == 'Windows':
-        extra_args = {'creationflags': CREATE_NO_WINDOW}
-        
     proc = sp.run([
         'ffprobe', "-loglevel", "panic",
         str(media), '-print_format', 'json', '-show_format', '-show_streams'
     ],
                   capture_output=True,
-                  **extra_args)
+                  **_subprocess_args())
     if proc.returncode:
         raise IOError(f"{media} does not exist or is of a wrong type.")
     return json.loads(proc.stdout.decode('utf-8'))
 
 
-def read_audio(audio, seek=None, duration=None):
+def prefetch_info(medias, workers=8, cache_dir=None):
+    """
+    Probe all the `medias` in parallel with `workers` threads, filling the caches of
+    `read_info`. Files which cannot be probed are ignored, the error is raised again
+    when they are actually used.
+    """
+    def probe(media):
+        try:
+            read_info(media, cache_dir=cache_dir)
+        except IOError:
+            pass
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        list(pool.map(probe, medias))
+
+
+def render_plan(audio, seek=None, duration=None, rate=60, cache_dir=None):
+    """
+    Return an estimate of the `duration` in seconds and number of `frames` of the video
+    `visualize` would generate for the `audio` file with the same `seek`, `duration` and
+    `rate`. It comes from the (cached) media info, without decoding the audio, so it is
+    only as good as the duration in the container metadata, which is often wrong e.g.
+    for VBR MP3 files without a header. `visualize` reports the exact number of frames,
+    once the audio is decoded, with `frame_callback(0, frames)`.
+    """
+    info = read_info(audio, cache_dir=cache_dir)
+    stream = audio_stream_info(audio, cache_dir=cache_dir)
+    length = float(stream.get('duration') or info['format']['duration'])
+    if seek is not None:
+        length = max(0., length - seek)
+    if duration is not None:
+        length = min(length, duration)
+    return {'duration': length, 'frames': int(rate * length)}
+
+
+def audio_stream_info(media, cache_dir=None):
+    """
+    Return the info of the first audio stream of the `media` file, which can be any
+    container, e.g. a video. This is the stream decoded by `read_audio` and muxed by
+    `visualize`.
+    """
+    info = read_info(media, cache_dir=cache_dir)
+    for stream in info['streams']:
+        if stream["codec_type"] == "audio":
+            return stream
+    raise ValueError(f"{media} does not contain any audio stream.")
+
+
+def _audio_stream(audio, cache_dir=None):
+    """
+    Internal function, return `(channels, samplerate)` for the `audio` file.
+    """
+    stream = audio_stream_info(audio, cache_dir=cache_dir)
+    return stream['channels'], float(stream['sample_rate'])
+
+
+def _decode_command(audio, seek=None, duration=None, samplerate=None, channels=None):
+    """
+    Internal function, ffmpeg command decoding `audio` to raw f32 samples on stdout.
+    If given, ffmpeg resamples the audio to `samplerate` and remixes it to `channels`.
+    """
+    # Good old ffmpeg
+    command = ['ffmpeg', '-y']
+    command += ['-loglevel', 'panic']
+    if seek is not None:
+        command += ['-ss', str(seek)]
+    command += ['-i', str(audio)]
+    if duration is not None:
+        command += ['-t', str(duration)]
+    # Only decode the first audio stream, whatever the container holds.
+    command += ['-map', '0:a:0']
+    if channels is not None:
+        command += ['-ac', str(channels)]
+    if samplerate is not None:
+        command += ['-ar', str(int(round(samplerate)))]
+    command += ['-f', 'f32le']
+    command += ['-']
+    return command
+
+
+def read_audio(audio, seek=None, duration=None, cancel=None):
+    """
+    Read the `audio` file, starting at `seek` (or 0) seconds for `duration` (or all)  seconds.
+    Returns `float[channels, samples]`. The decoding can be interrupted with the
+    `CancelToken` `cancel`.
+    """
+    channels, samplerate = _audio_stream(audio)
+    command = _decode_command(audio, seek, duration)
+    stdout = _run_process(command, cancel, capture=True)
+    wav = np.frombuffer(stdout, dtype=np.float32)
+    return wav.reshape(-1, channels).T, samplerate
+
+
+def read_audio_blocks(audio, seek=None, duration=None, blocksize=1 << 18, cache_dir=None,
+                      samplerate=None, channels=None, cancel=None):
+    """
+    Like `read_audio`, but decode the file progressively. Returns `(blocks, samplerate)`
+    where `blocks` is a generator of `float[channels, blocksize]` (the last block can be
+    shorter), so that memory does not depend on the length of the file.
+    `cache_dir` is passed to `read_info`. If `samplerate` or `channels` are given,
+    the audio is resampled or remixed by ffmpeg while decoding, which is much cheaper
+    than doing it in Python. The decoding can be interrupted with the `CancelToken` `cancel`.
+    """
+    native_channels, native_samplerate = _audio_stream(audio, cache_dir=cache_dir)
+    if samplerate is not None:
+        # ffmpeg only resamples to whole rates, the returned rate must be the same.
+        samplerate = int(round(samplerate))
+    command = _decode_command(audio, seek, duration, samplerate, channels)
+    if samplerate is None:
+        samplerate = native_samplerate
+    if channels is None:
+        channels = native_channels
+    return _iter_blocks(command, channels, blocksize, cancel), float(samplerate)
+
+
+def _iter_blocks(command, channels, blocksize, cancel=None):
+    if cancel is None:
+        cancel = CancelToken()
+    proc = sp.Popen(command, stdout=sp.PIPE, stderr=sp.DEVNULL, **_subprocess_args())
+    frame_bytes = 4 * channels
+    try:
+        with cancel.watch(proc):
+            while True:
+                data = proc.stdout.read(blocksize * frame_bytes)
+                # A cancelled decoder is killed, which looks like the end of the file.
+                cancel.check()
+                if not data:
+                    break
+                data = data[:len(data) - len(data) % frame_bytes]
+                yield np.frombuffer(data, dtype=np.float32).reshape(-1, channels).T
+            if proc.wait():
+                raise sp.CalledProcessError(proc.returncode, command)
+    finally:
+        _kill(proc)
+        proc.wait()
+        proc.stdout.close()
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def compress(env):
+    """
+    Some form of audio compressor based on the sigmoid, applied to the pooled envelope.
+    """
+    return 1.9 * (sigmoid(2.5 * env) - 0.5)
+
+
+def envelope(wav, window, stride):
+    """
+    Extract the envelope of the waveform `wav` (float[samples]), using average pooling
+    with `window` samples and the given `stride`.
+    """
+    wav = np.pad(np.maximum(wav, 0), window // 2)
+    # Average pooling in O(n) using a cumulative sum, accumulated in float64 to keep
+    # the difference of two large partial sums accurate on long inputs.
+    cumsum = np.zeros(len(wav) + 1)
+    np.cumsum(wav, dtype=np.float64, out=cumsum[1:])
+    offsets = np.arange(0, len(wav) - window, stride)
+    out = (cumsum[offsets + window] - cumsum[offsets]) / window
+    return compress(out)
+
+
+class StreamingEnvelope:
+    """
+    Incremental version of `envelope` for waveforms that are fed block by block with
+    `push`. As rectification and average pooling commute with a positive scaling,
+    the normalization by the standard deviation of the waveform is only applied in
+    `finish`, from a streaming variance. Memory is bounded by the block size, plus the
+    pooled envelope which is `stride` times smaller than the waveform.
+    """
+
+    def __init__(self, window, stride):
+        self.window = window
+        self.stride = stride
+        # Rectified samples not yet consumed by a window, starting with the left padding.
+        self._pending = np.zeros(window // 2, dtype=np.float32)
+        self._pooled = []
+        self.samples = 0
+        self._mean = 0.
+        self._m2 = 0.
+
+    def push(self, wav):
+        """
+        Feed the next `float[samples]` block of the waveform.
+        """
+        if not len(wav):
+            return
+        # Streaming variance, combining the statistics of each block (Chan et al.).
+        mean = float(wav.mean(dtype=np.float64))
+        m2 = float(np.square(wav - mean, dtype=np.float64).sum())
+        total = self.samples + len(wav)
+        delta = mean - self._mean
+        self._mean += delta * len(wav) / total
+        self._m2 += m2 + delta ** 2 * self.samples * len(wav) / total
+        self.samples = total
+        self._pool(np.maximum(wav, 0))
+
+    def _pool(self, rectified):
+        pending = np.concatenate([self._pending, rectified])
+        # Same condition as `envelope`: a window is only complete once at least one more
+        # sample follows it, which only the next block or the right padding can tell.
+        count = max(0, (len(pending) - self.window - 1) // self.stride + 1)
+        if count:
+            cumsum = np.zeros(len(pending) + 1)
+            np.cumsum(pending, dtype=np.float64, out=cumsum[1:])
+            offsets = np.arange(count) * self.stride
+            self._pooled.append((cumsum[offsets + self.window] - cumsum[offsets]) / self.window)
+        self._pending = pending[count * self.stride:]
+
+    def finish(self):
+        """
+        Return the envelope of all the samples pushed so far, normalized as if the
+        waveform had unit standard deviation.
+        """
+        self._pool(np.zeros(self.window // 2, dtype=np.float32))
+        out = np.concatenate(self._pooled) if self._pooled else np.zeros(0)
+        std = math.sqrt(self._m2 / self.samples) if self.samples else 0.
+        if std > 0:
+            out /= std
+        return compress(out)
+
+
+def analysis_window(sr, time, bars, oversample):
+    """
+    Return the `(window, stride)` in samples used to extract the envelope.
+    """
+    window = int(sr * time / bars)
+    stride = int(window / oversample)
+    return window, stride
+
+
+def analysis_samplerate(sr, time, bars, oversample, min_stride=32):
+    """
+    Return the sample rate to extract the envelope at, `sr` divided by the largest
+    integer factor for which the envelope is still pooled over `min_stride` samples or
+    more per step. The envelope does not need more resolution than that, so decoding at
+    a higher rate only costs bandwidth and memory. An integer factor keeps the pooling
+    windows aligned with the ones at the native rate, and it must divide `sr` exactly so
+    that ffmpeg resamples to exactly that rate, otherwise timings would drift.
+    """
+    _, stride = analysis_window(sr, time, bars, oversample)
+    sr = int(sr)
+    factor = max(1, stride // min_stride)
+    while sr % factor:
+        factor -= 1
+    return float(sr // factor)
+
+
+def envelope_error(audio, samplerate, bars, time, oversample, seek=None, duration=None,
+                   stereo=False, excerpt=10., pieces=5, cache_dir=None, cancel=None):
+    """
+    Compare the envelopes extracted at the native sample rate and at the reduced
+    `samplerate` over an `excerpt` of that many seconds of the `audio` file (restricted
+    to `seek` and `duration`), made of `pieces` spread from its start to its end, as
+    the content lost by resampling might only be in some part of it (e.g. the end of a
+    sweep). Returns the largest mean absolute difference over the pieces, envelopes
+    being interpolated on the same time grid.
+    """
+    plan = render_plan(audio, seek=seek, duration=duration, cache_dir=cache_dir)
+    length = excerpt / pieces
+    span = max(0., plan['duration'] - length)
+    errors = [0.]
+    for index in range(pieces):
+        start = (seek or 0) + (span * index / (pieces - 1) if pieces > 1 else span / 2)
+        results = []
+        for rate in [None, samplerate]:
+            envs, sr, _ = read_envelopes(audio, bars, time, oversample, seek=start,
+                                         duration=length, stereo=stereo, cache_dir=cache_dir,
+                                         analysis_rate=rate, cancel=cancel)
+            _, stride = analysis_window(sr, time, bars, oversample)
+            results.append((envs, np.arange(len(envs[0])) * stride / sr))
+        (full, full_time), (reduced, reduced_time) = results
+        if not len(full_time) or not len(reduced_time):
+            continue
+        errors += [np.abs(full_env - np.interp(full_time, reduced_time, reduced_env)).mean()
+                   for full_env, reduced_env in zip(full, reduced)]
+    return float(max(errors))
+
+
+def select_analysis_rate(audio, bars, time, oversample, seek=None, duration=None,
+                         stereo=False, tolerance=0.02, excerpt=10., cache_dir=None, cancel=None):
+    """
+    Return the reduced sample rate to extract the envelope of `audio` at (see
+    `analysis_samplerate`), or None if the native rate should be used: either the
+    envelope would differ by more than `tolerance` (see `envelope_error`), or the audio
+    is too short for the saving to pay for the check.
+    """
+    _, sr = _audio_stream(audio, cache_dir=cache_dir)
+    samplerate = analysis_samplerate(sr, time, bars, oversample)
+    if samplerate >= sr:
+        return None
+    plan = render_plan(audio, seek=seek, duration=duration, cache_dir=cache_dir)
+    if plan['duration'] < 3 * excerpt:
+        return None
+    error = envelope_error(audio, samplerate, bars, time, oversample, seek=seek,
+                           duration=duration, stereo=stereo, excerpt=excerpt,
+                           cache_dir=cache_dir, cancel=cancel)
+    if error > tolerance:
+        return None
+    return samplerate
+
+
+def read_envelopes(audio, bars, time, oversample, seek=None, duration=None, stereo=False,
+                   cache_dir=None, analysis_rate=None, cancel=None, on_progress=None):
+    """
+    Decode the `audio` file block by block and extract its envelope, see `visualize`
+    for the meaning of the arguments. Returns `(envs, samplerate, samples)` with `envs`
+    a list of envelopes over channels (a single one unless `stereo` is set) and `samples`
+    the number of decoded samples per channel. `cache_dir` is passed to `read_info`.
+    If `analysis_rate` is lower than the native sample rate, ffmpeg resamples the audio
+    to it (and downmixes it to mono unless `stereo` is set) before it reaches Python,
+    `samplerate` and `samples` are then given at that rate.
+    The decoding can be interrupted with the `CancelToken` `cancel`. `on_progress` is
+    called with the number of seconds of audio decoded so far after each block.
+    """
+    channels = 2 if stereo else 1
+    native_channels, native_sr = _audio_stream(audio, cache_dir=cache_dir)
+    if stereo and native_channels != 2:
+        raise ValueError('stereo requires stereo audio file')
+    if analysis_rate is not None and analysis_rate < native_sr:
+        blocks, sr = read_audio_blocks(audio, seek=seek, duration=duration,
+                                       cache_dir=cache_dir, samplerate=analysis_rate,
+                                       channels=channels, cancel=cancel)
+    else:
+        blocks, sr = read_audio_blocks(audio, seek=seek, duration=duration,
+                                       cache_dir=cache_dir, cancel=cancel)
+    window, stride = analysis_window(sr, time, bars, oversample)
+    extractors = [StreamingEnvelope(window, stride) for _ in range(channels)]
+    for block in blocks:
+        if stereo:
+            for extractor, wav in zip(extractors, block):
+                extractor.push(wav)
+        else:
+            extractors[0].push(block.mean(0))
+        if on_progress:
+            on_progress(extractors[0].samples / sr)
+    return [extractor.finish() for extractor in extractors], sr, extractors[0].samples
+
+
+def default_cache_dir():
+    """
+    Default location of the envelope cache, following the platform conventions.
+    """
+    if platform.system() == 'Windows':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(base) / 'seewav'
+
+
+def _evict(cache_dir, max_size):
+    """
+    Internal function, remove the least recently used entries of `cache_dir`, envelopes
+    and probes (see `read_info`), until it holds at most `max_size` bytes.
+    """
+    entries = []
+    for path in itertools.chain(Path(cache_dir).glob('*.npy'),
+                                Path(cache_dir).glob('probes/*.json')):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        # The metadata of an envelope goes first, as it marks the entry as valid.
+        victims = [path] if path.suffix == '.json' else [path.with_suffix('.json'), path]
+        for victim in victims:
+            try:
+                victim.unlink()
+            except OSError:
+                pass
+        total -= size
+
+
+def cached_envelopes(audio, bars, time, oversample, seek=None, duration=None, stereo=False,
+                     cache_dir=None, max_size=1 << 30, analysis_tolerance=None, cancel=None,
+                     on_progress=None):
+    """
+    Same as `read_envelopes`, but results are stored in `cache_dir` (no caching if None),
+    keyed by the path, modification time and size of `audio` and by the analysis
+    parameters, so that rendering the same audio with a different style does not decode
+    it again. Envelopes are stored as `.npy` files and memory mapped when loaded.
+    The least recently used entries are evicted once the cache exceeds `max_size` bytes.
+    If `analysis_tolerance` is not None, the audio is decoded at a reduced sample rate
+    when the envelope differs by less than that from the one at the native rate,
+    see `select_analysis_rate`. `on_progress` is only called when the audio is decoded.
+    """
+    def analyse():
+        analysis_rate = None
+        if analysis_tolerance is not None:
+            analysis_rate = select_analysis_rate(audio, bars, time, oversample, seek=seek,
+                                                 duration=duration, stereo=stereo,
+                                                 tolerance=analysis_tolerance,
+                                                 cache_dir=cache_dir, cancel=cancel)
+        return read_envelopes(audio, bars, time, oversample, seek=seek, duration=duration,
+                              stereo=stereo, cache_dir=cache_dir, analysis_rate=analysis_rate,
+                              cancel=cancel, on_progress=on_progress)
+
+    if cache_dir is None:
+        return analyse()
+    cache_dir = Path(cache_dir)
+    stat = os.stat(audio)
+    params = {
+        'audio': os.path.abspath(audio), 'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+        'seek': seek, 'duration': duration, 'time': time, 'bars': bars,
+        'oversample': oversample, 'stereo': stereo, 'analysis_tolerance': analysis_tolerance,
+    }
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+    data_path = cache_dir / f"{key}.npy"
+    meta_path = cache_dir / f"{key}.json"
+
+    # The metadata is written last, so an entry is only valid once it exists.
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        envs = np.load(data_path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    else:
+        # Refresh the access time used for the LRU eviction, a read-only cache is still used.
+        with contextlib.suppress(OSError):
+            os.utime(data_path)
+        return list(envs), meta['samplerate'], meta['samples']
+
+    envs, sr, samples = analyse()
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = data_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.stack(envs))
+        os.replace(tmp_path, data_path)
+        tmp_path = meta_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(params, samplerate=sr, samples=samples), f)
+        os.replace(tmp_path, meta_path)
+        _evict(cache_dir, max_size)
+    except OSError as err:
+        # The cache is only an optimization, never fail a render because of it.
+        print(f"Warning: could not write to the envelope cache: {err}", file=sys.stderr)
+    return envs, sr, samples
+
+
+@functools.lru_cache(maxsize=8)
+def _open_background(path, mtime):
+    image = Image.open(path)
+    image.load()
+    # resize image to be compatible with ffmpeg
+    if image.width % 2 == 1 or image.height % 2 == 1:
+        image = image.resize((image.width + image.width % 2, image.height + image.height % 2))
+    return image
+
+
+def load_background(path):
+    """
+    Open the background image at `path`, resized to even dimensions as required by ffmpeg.
+    Images are cached by path and modification time, so that many renders with the same
+    background in a single process only decode it once.
+    """
+    path = os.path.abspath(path)
+    return _open_background(path, os.path.getmtime(path))
+
+
+def pil_to_surface(image):
+    """
+    Internal function, create cairo surface from Pillow image
+    """
+    if 'A' not in image.getbands():
+        # convert rather than putalpha, which would modify the (possibly shared) image.
+        image = image.convert('RGBA')
+    return cairo.ImageSurface.create_for_data(bytearray(image.tobytes('raw', 'BGRa')), cairo.FORMAT_ARGB32, image.width, image.height)
+
+
+def bar_layout(bars):
+    """
+    Return `(width, pad, delta)`, the width of a bar, the padding on each side and the
+    distance between two consecutive bars, relative to the width of the frame.
+    """
+    pad_ratio = 0.1 # spacing ratio between 2 bars
+    width = 1. / (bars * (1 + 2 * pad_ratio))
+    pad = pad_ratio * width
+    delta = 2 * pad + width
+    return width, pad, delta
+
+
+def bar_rectangles(envs):
+    """
+    Compute the geometry of the bars for a frame, relative to the size of the frame.
+    envs is a list of envelopes over channels, each env is a float[bars] representing the
+    height of the envelope to draw. Returns for each channel a tuple `(left, top, height)`
+    of float[bars]. The width of the bars is given by `bar_layout`.
+    """
+    K = len(envs) # Number of waves to draw (waves are stacked vertically)
+    T = len(envs[0]) # Number of time steps
+    width, pad, delta = bar_layout(T)
+    left = pad + np.arange(T) * delta - width / 2
+    rects = []
+    for i, env in enumerate(envs):
+        half = 0.5 * np.asarray(env) / K # (semi-)height of the bar, as we stack K waves vertically
+        midrule = (1+2*i)/(2*K) # midrule of i-th wave
+        # The bottom half is 0.9 times the top half, both with the same opacity (no shadow).
+        rects.append((left, midrule - half, 1.9 * half))
+    return rects
+
+
+def has_cairo():
+    """
+    Return whether pycairo is installed, without importing it.
+    """
+    return importlib.util.find_spec('cairo') is not None
+
+
+class CairoRenderer:
+    """
+    Draw frames using cairo. The background (either `bg_color` or the Pillow `bg_image`)
+    is converted once to a premultiplied ARGB32 template, copied for each frame into one
+    of `buffers` preallocated frame buffers used in turn, so that drawing a frame does not
+    allocate any new pixel buffer. See `visualize` for the other arguments.
+    """
+
+    def __init__(self, fg_colors, fg_opacity, bg_color, bg_image, center, size, buffers=2):
+        if not has_cairo():
+            raise ImportError("pycairo is required by the cairo renderer, "
+                              "use the numpy renderer instead.")
+        self.fg_colors = fg_colors
+        self.fg_opacity = fg_opacity
+        self.size = size
+        if bg_image is None:
+            template = cairo.ImageSurface(cairo.FORMAT_ARGB32, *size)
+            ctx = cairo.Context(template)
+            ctx.scale(*size)
+            ctx.set_source_rgb(*bg_color)
+            ctx.rectangle(0, 0, 1, 1)
+            ctx.fill()
+            self.offset = [0, 0]
+        else:
+            template = pil_to_surface(bg_image)
+            # offset needs to be relative to the size of the surface, not the size of the background image
+            self.offset = [
+                (bg_image.width * center[0] - size[0] / 2) / size[0],
+                (bg_image.height * center[1] - size[1] / 2) / size[1]
+            ]
+        template.flush()
+        self.width = template.get_width()
+        self.height = template.get_height()
+        self.stride = template.get_stride()
+        self.template = bytes(template.get_data())
+        self.buffers = [bytearray(self.template) for _ in range(buffers)]
+        self.surfaces = [
+            cairo.ImageSurface.create_for_data(
+                buffer, cairo.FORMAT_ARGB32, self.width, self.height, self.stride)
+            for buffer in self.buffers
+        ]
+        self._next = 0
+
+    def render(self, envs):
+        """
+        Draw a single frame and return its raw BGRA pixels, see `draw`.
+        """
+        return self.draw(envs).get_data()
+
+    def draw(self, envs):
+        """
+        Draw a single frame (two frames for stereo). envs is a list of envelopes over
+        channels, each env is a float[bars] representing the height of the envelope
+        to draw. Each entry will be represented by a bar.
+        Returns the surface, whose buffer is reused after `buffers` more calls.
+        """
+        surface = self.surfaces[self._next]
+        buffer = self.buffers[self._next]
+        self._next = (self._next + 1) % len(self.surfaces)
+        surface.flush()
+        buffer[:] = self.template
+        surface.mark_dirty()
+
+        ctx = cairo.Context(surface)
+        ctx.scale(*self.size)
+        ctx.translate(*self.offset)
+        self._draw_bars(ctx, envs)
+        surface.flush()
+        return surface
+
+    def _draw_bars(self, ctx, envs):
+        # All the bars of a channel share the same colour, so they are added as rectangles
+        # to a single path, filled once per channel.
+        width = bar_layout(len(envs[0]))[0]
+        for i, (left, top, height) in enumerate(bar_rectangles(envs)):
+            ctx.set_source_rgba(*self.fg_colors[i], self.fg_opacity)
+            for x, y, h in zip(left.tolist(), top.tolist(), height.tolist()):
+                ctx.rectangle(x, y, width, h)
+            ctx.fill()
+
+
+def _color_to_byte(value):
+    # Same conversion as cairo, which first converts colours to 16 bits.
+    return int(min(max(value, 0.), 1.) * 65535 + 0.5) >> 8
+
+
+class NumpyRenderer:
+    """
+    Draw frames directly into preallocated `uint8[height, width, 4]` BGRA (premultiplied)
+    arrays, without cairo. Bars being axis aligned rectangles, each pixel is blended with
+    the exact area of the pixel they cover, which antialiases fractional edges. When bars
+    are less than a pixel apart (many bars on a small frame), the coverage of the pixels
+    they share is summed before blending. Same arguments as `CairoRenderer`.
+    """
+
+    def __init__(self, fg_colors, fg_opacity, bg_color, bg_image, center, size, buffers=2):
+        self.size = size
+        self.opacity = min(max(fg_opacity, 0.), 1.)
+        # Colours in BGRA order and premultiplied by the opacity, as float for blending.
+        self.fg_colors = [
+            np.array([_color_to_byte(c) for c in color[::-1]] + [255], dtype=np.float32)
+            for color in fg_colors
+        ]
+        if bg_image is None:
+            width, height = size
+            template = np.empty((height, width, 4), dtype=np.uint8)
+            template[..., :3] = [_color_to_byte(c) for c in bg_color[::-1]]
+            template[..., 3] = 255
+            self.offset = [0, 0]
+        else:
+            image = bg_image if 'A' in bg_image.getbands() else bg_image.convert('RGBA')
+            template = np.frombuffer(image.tobytes('raw', 'BGRa'), dtype=np.uint8)
+            template = template.reshape(image.height, image.width, 4)
+            # offset needs to be relative to the size of the frame, not the size of the background image
+            self.offset = [
+                (bg_image.width * center[0] - size[0] / 2) / size[0],
+                (bg_image.height * center[1] - size[1] / 2) / size[1]
+            ]
+        self.template = template
+        self.buffers = [template.copy() for _ in range(buffers)]
+        self._next = 0
+
+    def render(self, envs):
+        """
+        Draw a single frame (two frames for stereo), see `CairoRenderer.draw`.
+        Returns the frame as an array, which is reused after `buffers` more calls.
+        """
+        frame = self.buffers[self._next]
+        self._next = (self._next + 1) % len(self.buffers)
+        np.copyto(frame, self.template)
+        width = bar_layout(len(envs[0]))[0]
+        scale_x, scale_y = self.size
+        for i, (left, top, height) in enumerate(bar_rectangles(envs)):
+            x0 = (left + self.offset[0]) * scale_x
+            y0 = (top + self.offset[1]) * scale_y
+            self._fill(frame, x0, x0 + width * scale_x, y0, y0 + height * scale_y,
+                       self.fg_colors[i])
+        return frame
+
+    def _fill(self, frame, x0, x1, y0, y1, color):
+        """
+        Blend `color` over the rectangles `[x0, x1] x [y0, y1]` (float[bars] in pixels).
+        The fully covered inside of each bar is filled with a single slice assignment,
+        only the (at most two) partially covered rows and columns are blended with their
+        coverage.
+        """
+        if len(x0) > 1 and np.any(np.floor(x0[1:]) < np.ceil(x1[:-1])):
+            # Some bars share a column of pixels, blending them one after the other would
+            # blend those pixels twice instead of once with their total coverage.
+            self._fill_shared(frame, x0, x1, y0, y1, color)
+            return
+        rows, cols = frame.shape[:2]
+        solid = None
+        if self.opacity == 1:
+            # Opaque pixels are written as a single 32 bits word, much faster than 4 bytes.
+            pixels = frame.view(np.uint32)[..., 0]
+            solid = (color + 0.5).astype(np.uint8).view(np.uint32)[0]
+        for bx0, bx1, by0, by1 in zip(x0.tolist(), x1.tolist(), y0.tolist(), y1.tolist()):
+            c0, c1 = max(math.floor(bx0), 0), min(math.ceil(bx1), cols)
+            r0, r1 = max(math.floor(by0), 0), min(math.ceil(by1), rows)
+            if c0 >= c1 or r0 >= r1:
+                continue
+            col = np.arange(c0, c1)
+            cover_x = np.clip(np.minimum(bx1, col + 1) - np.maximum(bx0, col), 0, 1)
+            row = np.arange(r0, r1)
+            cover_y = np.clip(np.minimum(by1, row + 1) - np.maximum(by0, row), 0, 1)
+            # Fully covered rows and columns are contiguous, in the middle of the bar.
+            full_rows = np.flatnonzero(cover_y == 1)
+            full_cols = np.flatnonzero(cover_x == 1)
+            i0, i1 = (full_rows[0], full_rows[-1] + 1) if len(full_rows) else (0, 0)
+            j0, j1 = (full_cols[0], full_cols[-1] + 1) if len(full_cols) else (0, 0)
+            if solid is not None:
+                pixels[r0 + i0:r0 + i1, c0 + j0:c0 + j1] = solid
+            else:
+                self._blend(frame[r0 + i0:r0 + i1, c0 + j0:c0 + j1], color, self.opacity)
+            for i in np.flatnonzero(cover_y < 1).tolist():
+                alpha = (cover_y[i] * cover_x * self.opacity)[:, None]
+                self._blend(frame[r0 + i, c0:c1], color, alpha)
+            for j in np.flatnonzero(cover_x < 1).tolist():
+                alpha = cover_x[j] * self.opacity
+                self._blend(frame[r0 + i0:r0 + i1, c0 + j], color, alpha)
+
+    def _fill_shared(self, frame, x0, x1, y0, y1, color):
+        """
+        Same as `_fill`, for bars that can share pixels: the coverage of all the bars is
+        summed over the rows they span, then blended once.
+        """
+        rows, cols = frame.shape[:2]
+        r0, r1 = max(math.floor(y0.min()), 0), min(math.ceil(y1.max()), rows)
+        if r0 >= r1:
+            return
+        row = np.arange(r0, r1)[:, None]
+        coverage = np.zeros((r1 - r0, cols), dtype=np.float32)
+        for bx0, bx1, by0, by1 in zip(x0.tolist(), x1.tolist(), y0.tolist(), y1.tolist()):
+            c0, c1 = max(math.floor(bx0), 0), min(math.ceil(bx1), cols)
+            if c0 >= c1:
+                continue
+            col = np.arange(c0, c1)
+            cover_x = np.clip(np.minimum(bx1, col + 1) - np.maximum(bx0, col), 0, 1)
+            cover_y = np.clip(np.minimum(by1, row + 1) - np.maximum(by0, row), 0, 1)
+            coverage[:, c0:c1] += cover_y * cover_x
+        alpha = (np.minimum(coverage, 1) * self.opacity)[..., None]
+        self._blend(frame[r0:r1], color, alpha)
+
+    @staticmethod
+    def _blend(region, color, alpha):
+        # Premultiplied "over" operator, rounded to the nearest byte.
+        region[:] = region * (1 - np.float32(alpha)) + color * np.float32(alpha) + 0.5
+
+
+RENDERERS = {
+    'cairo': CairoRenderer,
+    'numpy': NumpyRenderer,
+}
+
+
+def draw_env(envs, out, fg_colors, fg_opacity, bg_color, bg_image, center, size):
+    """
+    Internal function, draw a single frame (two frames for stereo) using cairo and return
+    the surface. If `out` is not None, the frame is also saved to the `out` file as png.
+    envs is a list of envelopes over channels, each env is a float[bars] representing the
+    height of the envelope to draw. Each entry will be represented by a bar.
+    To draw many frames, use a `CairoRenderer` which only prepares the background once.
+    """
+    renderer = CairoRenderer(fg_colors, fg_opacity, bg_color, bg_image, center, size, buffers=1)
+    surface = renderer.draw(envs)
+    if out is not None:
+        surface.write_to_png(out)
+    return surface
+
+
+def interpole(x1, y1, x2, y2, x):
+    return y1 + (y2 - y1) * (x - x1) / (x2 - x1)
+
+
+def bar_heights(envs, idx, rate, sr, stride, bars, speed):
+    """
+    Compute the height of the bars for the frames `idx` (int[frames]), interpolating
+    between two consecutive windows of the padded envelopes `envs`.
+    Returns `float[frames, channels, bars]`.
+    """
+    idx = np.asarray(idx)
+    pos = (((idx / rate)) * sr) / stride / bars
+    off = pos.astype(int)
+    loc = (pos - off)[:, None]
+    # Indices of the first window we interpolate from, int[frames, bars].
+    index = off[:, None] * bars + np.arange(bars)
+    smooth = np.hanning(bars)
+    heights = np.empty((len(idx), len(envs), bars))
+    for i, env in enumerate(envs):
+        env1 = env[index]
+        env2 = env[index + bars]
+
+        # we want loud parts to be updated faster
+        maxvol = np.log10(1e-4 + env2.max(axis=1, keepdims=True)) * 10
+        speedup = np.clip(interpole(-6, 0.5, 0, 2, maxvol), 0.5, 2)
+        w = sigmoid(speed * speedup * (loc - 0.5))
+        heights[:, i] = ((1 - w) * env1 + w * env2) * smooth
+    return heights
+
+
+def iter_bar_heights(envs, frames, rate, sr, stride, bars, speed, chunk=1024, start=0):
+    """
+    Same as `bar_heights` for all the frames from `start` up to `frames`, computed `chunk`
+    frames at a time so that memory stays bounded for long inputs. Yields
+    `float[channels, bars]` for each frame.
+    """
+    for start in range(start, frames, chunk):
+        idx = np.arange(start, min(start + chunk, frames))
+        yield from bar_heights(envs, idx, rate, sr, stride, bars, speed)
+
+
+# State shared by all the frames of a render, set in each worker process by `_init_worker`.
+_worker_state = None
+
+
+def _exit_worker(signum, frame):
+    sys.exit(1)
+
+
+def _init_worker(state):
+    global _worker_state
+    # Pool.terminate sends SIGTERM, exit through the normal exception handling so that
+    # the ffmpeg encoding a segment is killed too, see `_pipe_frames`.
+    signal.signal(signal.SIGTERM, _exit_worker)
+    # Renderers hold frame buffers (and cairo surfaces) which are not pickled, each process
+    # creates its own.
+    renderer = RENDERERS[state['renderer']](**state['style'])
+    _worker_state = dict(state, frame_renderer=renderer)
+
+
+def _render_frame(heights):
+    """
+    Internal function, render a frame with the bar `heights` (float[channels, bars])
+    using `_worker_state` and return its raw BGRA pixels.
+    """
+    return _worker_state['frame_renderer'].render(heights)
+
+
+def _render_frame_bytes(heights):
+    # memoryviews cannot be pickled back to the parent process.
+    return bytes(_render_frame(heights))
+
+
+def _mark_duplicates(heights, tolerance):
+    """
+    Internal function, yield `(row, duplicate)` for each row of `heights`, `duplicate`
+    being True when no bar moved by more than `tolerance` (None to never skip a frame)
+    since the last frame that was not a duplicate.
+    """
+    previous = None
+    for row in heights:
+        duplicate = False
+        if previous is not None and tolerance is not None:
+            if tolerance == 0:
+                duplicate = np.array_equal(row, previous)
+            else:
+                duplicate = np.abs(row - previous).max() <= tolerance
+        if not duplicate:
+            previous = row
+        yield row, duplicate
+
+
+def render_frames(state, heights, workers=1, dedup=0., stats=None, renderer=None):
+    """
+    Yield the raw BGRA pixels of each frame, in order, with the bar heights given by the
+    iterable `heights` and the style described by `state` (see `visualize`), drawn by
+    `renderer` if given (e.g. reused for many segments), otherwise by a new one.
+    With `workers > 1`, frames are rendered by a process pool, with at most a few frames
+    per worker in flight so that memory stays bounded when the encoder is slower than the
+    renderers.
+    Frames whose bars did not move by more than `dedup` (None to disable) are not rendered,
+    the previous frame is yielded again instead. The number of such frames is stored in
+    `stats['skipped']` if `stats` is given.
+    """
+    if stats is None:
+        stats = {}
+    stats['skipped'] = 0
+    marked = _mark_duplicates(heights, dedup)
+    if workers <= 1:
+        # Not using the global `_worker_state`, as many renders can run in threads
+        # of the same process, see `serve`.
+        if renderer is None:
+            renderer = RENDERERS[state['renderer']](**state['style'])
+        data = None
+        for row, duplicate in marked:
+            if duplicate:
+                stats['skipped'] += 1
+            else:
+                data = renderer.render(row)
+            yield data
+        return
+
+    with _spawn_context().Pool(workers, initializer=_init_worker, initargs=(state,)) as pool:
+        pending = collections.deque()
+        data = None
+        for row, duplicate in marked:
+            if duplicate:
+                stats['skipped'] += 1
+                pending.append(None)
+            else:
+                pending.append(pool.apply_async(_render_frame_bytes, (row,)))
+            if len(pending) >= 4 * workers:
+                result = pending.popleft()
+                data = data if result is None else result.get()
+                yield data
+        while pending:
+            result = pending.popleft()
+            data = data if result is None else result.get()
+            yield data
+
+
+# Named encoder settings, see `encoder_settings`.
+ENCODER_PROFILES = {
+    # Near lossless, the historical settings of seewav.
+    'default': {'crf': 10, 'preset': 'veryfast'},
+    # Fastest encode, to check a render.
+    'draft': {'crf': 28, 'preset': 'ultrafast'},
+    # Good quality for flat colour animations at a reasonable size.
+    'web': {'crf': 23, 'preset': 'medium', 'tune': 'animation', 'audio_bitrate': '128k'},
+    # Visually lossless, slower encode.
+    'archive': {'crf': 16, 'preset': 'slow', 'tune': 'animation', 'audio_bitrate': '256k'},
+    # Same speed as default, much smaller files for bars over a solid background.
+    'animation': {'crf': 18, 'preset': 'veryfast', 'tune': 'animation'},
+}
+
+_ENCODER_DEFAULTS = {
+    'codec': 'libx264', 'crf': None, 'bitrate': None, 'preset': None, 'tune': None,
+    'gop': None, 'pix_fmt': 'yuv420p', 'threads': 8,
+    'audio_codec': 'aac', 'audio_bitrate': None,
+}
+
+
+def encoder_settings(profile='default', **overrides):
+    """
+    Return the encoder settings of the named `profile` (see `ENCODER_PROFILES`), updated
+    with the `overrides` which are not None. Settings are the video `codec`, either a
+    `crf` or a target `bitrate` (e.g. '4M'), the encoder `preset` and `tune`, the `gop`
+    (keyframe interval in frames), the `pix_fmt`, the number of `threads`, the
+    `audio_codec` and `audio_bitrate`.
+    """
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile {profile}, "
+                         f"should be one of {', '.join(ENCODER_PROFILES)}.")
+    settings = dict(_ENCODER_DEFAULTS, **ENCODER_PROFILES[profile])
+    for key, value in overrides.items():
+        if key not in settings:
+            raise ValueError(f"Unknown encoder setting {key}.")
+        if value is not None:
+            settings[key] = value
+    if overrides.get('bitrate') is not None and overrides.get('crf') is None:
+        # An explicit bitrate replaces the constant quality of the profile.
+        settings['crf'] = None
+    return settings
+
+
+def encoder_args(settings):
+    """
+    Convert encoder `settings` (see `encoder_settings`) to ffmpeg output arguments.
+    Returns `(video_args, audio_args)`.
+    """
+    video_args = ["-vcodec", settings['codec']]
+    if settings['crf'] is not None:
+        video_args += ["-crf", str(settings['crf'])]
+    if settings['bitrate'] is not None:
+        video_args += ["-b:v", str(settings['bitrate'])]
+    video_args += ["-pix_fmt", settings['pix_fmt']]
+    if settings['threads'] is not None:
+        video_args += ["-threads", str(settings['threads'])]
+    if settings['preset'] is not None:
+        video_args += ["-preset", settings['preset']]
+    if settings['tune'] is not None:
+        video_args += ["-tune", settings['tune']]
+    if settings['gop'] is not None:
+        video_args += ["-g", str(settings['gop'])]
+    audio_args = ["-c:a", settings['audio_codec']]
+    if settings['audio_bitrate'] is not None:
+        audio_args += ["-b:a", str(settings['audio_bitrate'])]
+    return video_args, audio_args
+
+
+# Upper bounds in seconds of the buckets of `Histogram`, the last one catches the rest.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.)
+
+
+class Histogram:
+    """
+    Distribution of durations in seconds, counted in the `LATENCY_BUCKETS`.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        """
+        Return the `count`, `mean`, `max` and the `buckets` as `[upper bound, count]` pairs,
+        the upper bound of the last bucket being None.
+        """
+        return {
+            'count': self.count, 'mean': self.total / self.count if self.count else 0.,
+            'max': self.max,
+            'buckets': [[bound, count] for bound, count
+                        in zip(list(LATENCY_BUCKETS) + [None], self.counts)],
+        }
+
+
+class Metrics:
+    """
+    Instrumentation of a render, see the `metrics` argument of `visualize`. The start and
+    stop of each `stage` are reported to `on_event` (if not None) as dicts with an `event`
+    name, `stage_start` or `stage_stop`, and a `time`, `stage_stop` events also having the
+    `wall` and `cpu` seconds of the stage. Frames are only aggregated, see `summary`.
+    """
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.stages = {}
+        # Time to get each frame from the renderer, and blocked writing it to ffmpeg.
+        self.frame_render = Histogram()
+        self.frame_write = Histogram()
+        self.bytes_piped = 0
+        # Time spent waiting for ffmpeg to finish once all the frames were sent.
+        self.encoder_flush = 0.
+
+    def emit(self, event, **data):
+        if self.on_event is not None:
+            self.on_event(dict(data, event=event, time=time.time()))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the wall and CPU (of this process) duration of the stage `name`.
+        """
+        self.emit('stage_start', stage=name)
+        wall = perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            timing = {'wall': perf_counter() - wall, 'cpu': time.process_time() - cpu}
+            self.stages[name] = timing
+            self.emit('stage_stop', stage=name, **timing)
+
+    def summary(self):
+        """
+        Return the timing of the `stages`, the histograms of the frame latencies
+        `frame_render` and `frame_write`, the number of `bytes_piped` to ffmpeg and the
+        `subprocess_wait`, i.e. the time spent blocked on ffmpeg.
+        """
+        return {
+            'stages': dict(self.stages),
+            'frame_render': self.frame_render.summary(),
+            'frame_write': self.frame_write.summary(),
+            'bytes_piped': self.bytes_piped,
+            'subprocess_wait': self.frame_write.total + self.encoder_flush,
+        }
+
+
+# Cost in seconds of one unit of work of each stage of `visualize`, only used to estimate
+# the stages that did not start yet, the others use their measured throughput.
+STAGE_COSTS = {
+    'analysis': 0.005,  # per second of audio decoded
+    'frames': 0.02,  # per frame rendered and piped to ffmpeg
+    # Encoding overlaps with the frames, only the ones buffered by ffmpeg are left at the end.
+    'encode': 0.0005,  # per frame encoded
+    'mux': 0.05,  # per second of video joined from the `segments`, encoding the audio
+}
+
+
+class RenderProgress:
+    """
+    Progress model of a render made of successive `stages`, given as `(name, total, unit)`,
+    each counting its own unit of work (e.g. seconds of audio decoded, frames rendered).
+    `update` reports the work done in a stage, which completes the previous ones, and
+    calls `on_update` (if not None) with a dict with the `stage` name, its `done` and
+    `total` work, its `unit` and `throughput` (units per second), the overall `percent`
+    of the render and its `eta` in seconds.
+
+    Stages are weighted by their duration: the actual one for completed stages, the one
+    extrapolated from the throughput measured since the current stage started, and
+    `total` times the cost per unit (see `STAGE_COSTS`, overridden by `costs`) for the
+    next ones.
+    The overall `percent` is the share of the expected duration already spent, and
+    never goes backward.
+    """
+
+    def __init__(self, stages, on_update=None, costs=None):
+        self.stages = [[name, float(total), unit] for name, total, unit in stages]
+        self.costs = dict(STAGE_COSTS, **(costs or {}))
+        self.on_update = on_update
+        self.current = 0
+        self.done = 0.
+        # Work already done when the current stage started, e.g. resumed segments.
+        self.base = 0.
+        self.begin = perf_counter()
+        self.started = self.begin
+        self.percent = 0.
+
+    def _index(self, name):
+        for index, stage in enumerate(self.stages):
+            if stage[0] == name:
+                return index
+        raise ValueError(f"Unknown stage {name}")
+
+    def set_total(self, name, total):
+        """
+        Change the `total` work of the stage `name`, e.g. once the exact number of frames
+        is known.
+        """
+        self.stages[self._index(name)][1] = float(total)
+
+    def update(self, name, done):
+        index = self._index(name)
+        if index < self.current:
+            return
+        if index > self.current:
+            self.current = index
+            self.started = perf_counter()
+            self.base = float(done)
+        self.done = float(done)
+        self._report()
+
+    def finish(self):
+        """
+        Mark the render as complete.
+        """
+        self.current = len(self.stages) - 1
+        self.done = self.stages[-1][1]
+        self._report(final=True)
+
+    def estimate(self):
+        """
+        Return the seconds elapsed since the render started, and the remaining ones.
+        """
+        now = perf_counter()
+        name, total, _ = self.stages[self.current]
+        left = max(0., total - self.done)
+        if self.done > self.base:
+            remaining = left * (now - self.started) / (self.done - self.base)
+        else:
+            remaining = left * self.costs.get(name, 0.)
+        for name, total, _ in self.stages[self.current + 1:]:
+            remaining += total * self.costs.get(name, 0.)
+        return now - self.begin, remaining
+
+    def _report(self, final=False):
+        elapsed, remaining = self.estimate()
+        if final:
+            remaining = 0.
+        if elapsed + remaining > 0:
+            self.percent = max(self.percent, 100 * elapsed / (elapsed + remaining))
+        name, total, unit = self.stages[self.current]
+        if self.on_update is not None:
+            stage_time = perf_counter() - self.started
+            self.on_update({
+                'stage': name, 'done': self.done, 'total': total, 'unit': unit,
+                'throughput': (self.done - self.base) / stage_time if stage_time > 0 else 0.,
+                'percent': 100. if final else self.percent, 'eta': remaining,
+            })
+
+
+def _raw_input_args(size, rate):
     """
-    Read the `audio` file, starting at `seek` (or 0) seconds for `duration` (or all)  seconds.
-    Returns `float[channels, samples]`.
+    Internal function, ffmpeg arguments reading raw BGRA frames of the given `size` from
+    stdin. This is the memory layout of cairo ARGB32 surfaces on little endian machines.
     """
+    return [
+        "-f", "rawvideo", "-pix_fmt", "bgra",
+        "-s", f"{size[0]}x{size[1]}",
+        "-r", str(rate), "-i", "-"
+    ]
 
-    info = read_info(audio)
-    channels = None
-    stream = info['streams'][0]
-    if stream["codec_type"] != "audio":
-        raise ValueError(f"{audio} should contain only audio.")
-    channels = stream['channels']
-    samplerate = float(stream['sample_rate'])
 
-    # Good old ffmpeg
-    command = ['ffmpeg', '-y']
-    command += ['-loglevel', 'panic']
-    if seek is not None:
-        command += ['-ss', str(seek)]
-    command += ['-i', audio]
-    if duration is not None:
-        command += ['-t', str(duration)]
-    command += ['-f', 'f32le']
-    command += ['-']
+def _pipe_closed(err, process):
+    """
+    Internal function, True if the `OSError` `err`, raised while writing to the stdin of
+    `process`, only means that the process exited. Windows raises `EINVAL` rather than
+    `BrokenPipeError`, this is the same test as `subprocess.Popen.communicate`.
+    """
+    if isinstance(err, BrokenPipeError):
+        return True
+    return err.errno == errno.EINVAL and process.poll() is not None
 
-    # Set subprocess flags based on platform
-    extra_args = {}
-    if platform.system() == 'Windows':
-        extra_args = {'creationflags': CREATE_NO_WINDOW}
-        
-    proc = sp.run(command, check=True, capture_output=True, **extra_args)
-    wav = np.frombuffer(proc.stdout, dtype=np.float32)
-    return wav.reshape(-1, channels).T, samplerate
 
+def _pipe_frames(command, frames, on_frame=None, cancel=None, metrics=None, on_encoded=None):
+    """
+    Internal function, run the ffmpeg `command` and write each raw frame from the
+    generator `frames` to its stdin. `on_frame` is called with the index of each frame
+    once written. Once all the frames are written, `on_encoded` (if not None) is called
+    with the number of frames ffmpeg encoded so far, every 0.1 seconds until it is done,
+    so that flushing the encoder is not a black box. Raises `CalledProcessError` if ffmpeg fails, ffmpeg is killed if
+    anything goes wrong on our side, or as soon as the `CancelToken` `cancel` is cancelled.
+    Frame latencies and bytes written are recorded in `metrics`, see `Metrics`.
+    """
+    if cancel is None:
+        cancel = CancelToken()
+    if metrics is None:
+        metrics = Metrics()
+    encoded = [0]
+    if on_encoded is not None:
+        command = _with_progress(command)
 
-def sigmoid(x):
-    return 1 / (1 + np.exp(-x))
+    def record(block):
+        try:
+            encoded[0] = int(block.get('frame', ''))
+        except ValueError:
+            pass
+
+    encoder = sp.Popen(command, stdin=sp.PIPE, stdout=None if on_encoded is None else sp.PIPE,
+                       **_subprocess_args())
+    if on_encoded is not None:
+        # ffmpeg writes its progress all along, it must be read so that it never blocks.
+        threading.Thread(target=_parse_progress, args=(encoder.stdout, record),
+                         daemon=True).start()
+    try:
+        with cancel.watch(encoder):
+            begin = perf_counter()
+            for idx, data in enumerate(frames):
+                cancel.check()
+                rendered = perf_counter()
+                metrics.frame_render.add(rendered - begin)
+                try:
+                    encoder.stdin.write(data)
+                except OSError as err:
+                    if not _pipe_closed(err, encoder):
+                        cancel.check()
+                        raise
+                    # ffmpeg died or was killed by `cancel`, reported below.
+                    break
+                metrics.frame_write.add(perf_counter() - rendered)
+                metrics.bytes_piped += memoryview(data).nbytes
+                if on_frame:
+                    on_frame(idx)
+                begin = perf_counter()
+            begin = perf_counter()
+            try:
+                encoder.stdin.close()
+            except OSError as err:
+                if not _pipe_closed(err, encoder):
+                    cancel.check()
+                    raise
+            while True:
+                if on_encoded is not None:
+                    on_encoded(encoded[0])
+                try:
+                    encoder.wait(0.1)
+                except sp.TimeoutExpired:
+                    continue
+                break
+            metrics.encoder_flush += perf_counter() - begin
+        cancel.check()
+        if encoder.returncode:
+            raise sp.CalledProcessError(encoder.returncode, command)
+    except BaseException:
+        _kill(encoder)
+        encoder.wait()
+        raise
+    finally:
+        frames.close()
 
 
-def envelope(wav, window, stride):
+def _render_segment(task, state=None, cancel=None):
     """
-    Extract the envelope of the waveform `wav` (float[samples]), using average pooling
-    with `window` samples and the given `stride`.
+    Internal function, render and encode the frames `start` to `stop` (excluded) to the
+    video `path`, without audio, using `state` (defaults to `_worker_state`). The video is
+    only moved to `path` once complete, so an existing `path` is always a valid segment.
+    Returns the number of frames and of skipped frames.
     """
-    # pos = np.pad(np.maximum(wav, 0), window // 2)
-    wav = np.pad(wav, window // 2)
-    out = []
-    for off in range(0, len(wav) - window, stride):
-        frame = wav[off:off + window]
-        out.append(np.maximum(frame, 0).mean())
-    out = np.array(out)
-    # Some form of audio compressor based on the sigmoid.
-    out = 1.9 * (sigmoid(2.5 * out) - 0.5)
-    return out
-    
-def pil_to_surface(image):
+    start, stop, path = task
+    st = _worker_state if state is None else state
+    path = Path(path)
+    partial = path.with_name(path.stem + '.partial' + path.suffix)
+    command = [
+        "ffmpeg", "-y",
+        "-loglevel", "panic",
+    ] + _raw_input_args(st['frame_size'], st['rate']) + [
+        "-an",
+    ] + st['video_args'] + [
+        str(partial)
+    ]
+    if st.get('frame_store') is not None:
+        # Rows of the memory mapped `FrameStore`, read without copying them.
+        heights = iter(np.load(st['frame_store'], mmap_mode='r')[start:stop])
+    else:
+        heights = iter_bar_heights(st['envs'], stop, st['rate'], st['sr'], st['stride'],
+                                   st['bars'], st['speed'], start=start)
+    stats = {}
+    try:
+        # The renderer of the worker (see `_init_worker`), created once for all its segments.
+        frames = render_frames(st, heights, dedup=st['dedup'], stats=stats,
+                               renderer=st.get('frame_renderer'))
+        _pipe_frames(command, frames, cancel=cancel)
+    except BaseException:
+        if partial.exists():
+            partial.unlink()
+        raise
+    os.replace(partial, path)
+    return stop - start, stats['skipped']
+
+
+def _iter_results(results, cancel, timeout=0.1):
     """
-    Internal function, create cairo surface from Pillow image
+    Internal function, yield from the `results` of `Pool.imap_unordered`, checking the
+    `CancelToken` `cancel` every `timeout` seconds while waiting.
     """
-    if 'A' not in image.getbands():
-        image.putalpha(int(256))
-    return cairo.ImageSurface.create_for_data(bytearray(image.tobytes('raw', 'BGRa')), cairo.FORMAT_ARGB32, image.width, image.height)
+    while True:
+        try:
+            yield results.next(timeout)
+        except StopIteration:
+            return
+        except multiprocessing.TimeoutError:
+            cancel.check()
 
-def draw_env(envs, out, fg_colors, fg_opacity, bg_color, bg_image, center, size):
+
+def render_segments(state, frames, out, audio_cmd, segments, workers, fingerprint,
+                    stats=None, on_frames=None, cancel=None, on_mux=None):
     """
-    Internal function, draw a single frame (two frames for stereo) using cairo and save
-    it to the `out` file as png. envs is a list of envelopes over channels, each env
-    is a float[bars] representing the height of the envelope to draw. Each entry will
-    be represented by a bar.
+    Render the video `out` as `segments` chunks, rendered and encoded independently by a
+    pool of `workers` processes (each with its own ffmpeg), then joined with the concat
+    demuxer while muxing the audio given by the ffmpeg arguments `audio_cmd`.
+    `state` is the same as for `render_frames`, with the envelopes and analysis parameters
+    (see `visualize`), as well as the encoder arguments `video_args` which must use a
+    fixed `gop`, so that chunks are aligned on keyframes.
+
+    Finished chunks are kept in a `.parts` folder next to `out` until the final video is
+    complete, so that an interrupted render resumes from the completed chunks, as long as
+    `fingerprint` (any string identifying the render) did not change.
+    `on_frames` is called with the total number of frames done after each chunk, then
+    `on_mux` with the seconds of video joined so far.
+    The render can be interrupted with the `CancelToken` `cancel`, completed chunks are
+    kept to resume it later.
     """
-    if bg_image is None:
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *size)
-        offset = [0, 0]
+    if cancel is None:
+        cancel = CancelToken()
+    if stats is None:
+        stats = {}
+    stats.setdefault('skipped', 0)
+    gop = state['gop']
+    # At least one GOP, a clip shorter than a frame has no frame at all.
+    chunk = max(gop, math.ceil(frames / segments / gop) * gop)
+    parts = out.with_name(out.name + '.parts')
+    marker = parts / 'render.json'
+    if parts.exists():
+        try:
+            reusable = marker.read_text(encoding='utf-8') == fingerprint
+        except OSError:
+            reusable = False
+        if not reusable:
+            shutil.rmtree(parts)
+    parts.mkdir(parents=True, exist_ok=True)
+    marker.write_text(fingerprint, encoding='utf-8')
+
+    tasks = []
+    done = 0
+    paths = []
+    for index, start in enumerate(range(0, frames, chunk)):
+        path = parts / f"segment_{index:05d}.mp4"
+        paths.append(path)
+        if path.exists():
+            done += min(chunk, frames - start)
+        else:
+            tasks.append((start, min(start + chunk, frames), str(path)))
+    if done and on_frames:
+        on_frames(done)
+
+    if workers <= 1:
+        state = dict(state, frame_renderer=RENDERERS[state['renderer']](**state['style']))
+        results = (_render_segment(task, state, cancel) for task in tasks)
+        pool = None
     else:
-        surface = pil_to_surface(bg_image)
-        # offset needs to be relative to the size of the surface, not the size of the background image
-        offset = [
-            (bg_image.width * center[0] - size[0] / 2) / size[0],
-            (bg_image.height * center[1] - size[1] / 2) / size[1]
+        pool = _spawn_context().Pool(min(workers, max(1, len(tasks))),
+                                     initializer=_init_worker, initargs=(state,))
+        results = _iter_results(pool.imap_unordered(_render_segment, tasks), cancel)
+    try:
+        for count, skipped in results:
+            done += count
+            stats['skipped'] += skipped
+            if on_frames:
+                on_frames(done)
+    except Cancelled:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        # Chunks being encoded by the workers are incomplete.
+        for partial in parts.glob('*.partial.mp4'):
+            partial.unlink()
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if paths:
+        listing = parts / 'segments.txt'
+        with open(listing, 'w', encoding='utf-8') as f:
+            for path in paths:
+                f.write(f"file '{path.name}'\n")
+        inputs = ["-f", "concat", "-safe", "0", "-i", str(listing)] + audio_cmd + [
+            "-map", "0:v:0", "-map", "1:a:0",
+            "-c:v", "copy",
         ]
-    ctx = cairo.Context(surface)
-    ctx.scale(*size)
-    if bg_image is None:
-        ctx.set_source_rgb(*bg_color)
-        ctx.rectangle(0, 0, 1, 1)
-        ctx.fill()
+    else:
+        # No frame to render, only the audio is written, as with a single stream.
+        inputs = audio_cmd + ["-map", "0:a:0"]
+    _run_process([
+        "ffmpeg", "-y",
+        "-loglevel", "panic",
+    ] + inputs + [
+        str(out.resolve())
+    ], cancel, on_progress=on_mux and (lambda block: on_mux(_progress_seconds(block))))
+    shutil.rmtree(parts)
 
-    K = len(envs) # Number of waves to draw (waves are stacked vertically)
-    T = len(envs[0]) # Numbert of time steps
-    pad_ratio = 0.1 # spacing ratio between 2 bars
-    width = 1. / (T * (1 + 2 * pad_ratio))
-    pad = pad_ratio * width
-    delta = 2 * pad + width
 
-    ctx.translate(*offset)
-    ctx.set_line_width(width)
-    for step in range(T):
-        for i in range(K):
-            half = 0.5 * envs[i][step] # (semi-)height of the bar
-            half /= K # as we stack K waves vertically
-            midrule = (1+2*i)/(2*K) # midrule of i-th wave
-            # Top half of the wave - full opacity
-            ctx.set_source_rgba(*fg_colors[i], fg_opacity)
-            ctx.move_to(pad + step * delta, midrule - half)
-            ctx.line_to(pad + step * delta, midrule)
-            ctx.stroke()
-            # Bottom half of the wave - same opacity (no shadow)
-            ctx.set_source_rgba(*fg_colors[i], fg_opacity)
-            ctx.move_to(pad + step * delta, midrule)
-            ctx.line_to(pad + step * delta, midrule + 0.9 * half)
-            ctx.stroke()
-
-    surface.write_to_png(out)
+class FrameStore:
+    """
+    Bar heights of every frame of a render, `float[frames, channels, bars]`, stored in the
+    memory mapped `.npy` file `path`, with a JSON sidecar next to it (`path` + `.json`)
+    holding the `params` of the render they were computed for, the `duration` of the
+    video and the number of frames `written` so far. Frames are read from the memory map
+    without any copy, so a complete store lets a render skip the audio analysis (e.g. to
+    encode again with other encoder settings or colors). A store left incomplete by an
+    interrupted render is completed by the next one, which still analyses the audio and
+    renders and encodes every frame again (only `segments` resume the video itself).
+    Use `load` or `create` rather than the constructor.
+    """
+
+    def __init__(self, path, heights, meta):
+        self.path = Path(path)
+        self.heights = heights
+        self.params = meta['params']
+        self.duration = meta['duration']
+        self.written = meta['written']
 
+    @staticmethod
+    def _sidecar(path):
+        path = Path(path)
+        return path.with_name(path.name + '.json')
 
-def interpole(x1, y1, x2, y2, x):
-    return y1 + (y2 - y1) * (x - x1) / (x2 - x1)
+    @classmethod
+    def load(cls, path, params):
+        """
+        Open the store at `path` if it exists and was made for the same `params` (a JSON
+        serializable dict), otherwise return None.
+        """
+        try:
+            with open(cls._sidecar(path), encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['params'] != json.loads(json.dumps(params)):
+                return None
+            heights = np.lib.format.open_memmap(path, mode='r+')
+        except (OSError, ValueError, KeyError):
+            return None
+        return cls(path, heights, meta)
+
+    @classmethod
+    def create(cls, path, params, frames, channels, bars, duration):
+        """
+        Create an empty store at `path`, replacing any previous one.
+        """
+        sidecar = cls._sidecar(path)
+        if sidecar.exists():
+            # An existing store is only valid once it has a sidecar, remove it first.
+            sidecar.unlink()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        heights = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                            shape=(frames, channels, bars))
+        store = cls(path, heights, {'params': json.loads(json.dumps(params)),
+                                    'duration': duration, 'written': 0})
+        store.commit(0)
+        return store
+
+    @property
+    def frames(self):
+        return len(self.heights)
+
+    @property
+    def complete(self):
+        return self.written >= self.frames
+
+    def commit(self, written):
+        """
+        Flush the heights to disk and record that the first `written` frames are valid.
+        """
+        self.heights.flush()
+        self.written = written
+        sidecar = self._sidecar(self.path)
+        tmp_path = sidecar.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'params': self.params, 'duration': self.duration, 'written': written}, f)
+        os.replace(tmp_path, sidecar)
+
+    def record(self, heights, start=0, every=1024):
+        """
+        Write the rows of the iterable `heights` from the frame `start`, yielding each
+        one as stored, and commit them every `every` frames and at the end.
+        """
+        index = start
+        try:
+            for row in heights:
+                self.heights[index] = row
+                # Counted before it is yielded, the consumer might stop there.
+                index += 1
+                yield self.heights[index - 1]
+                if (index - start) % every == 0:
+                    self.commit(index)
+        finally:
+            if index > self.written:
+                self.commit(index)
+
+    def iter_heights(self, envs, rate, sr, stride, bars, speed):
+        """
+        Yield the bar heights of all the frames, from the store for the frames already
+        `written`, then computed with `iter_bar_heights` and recorded.
+        """
+        written = self.written
+        yield from self.heights[:written]
+        if written < self.frames:
+            yield from self.record(iter_bar_heights(envs, self.frames, rate, sr, stride, bars,
+                                                    speed, start=written), start=written)
+
+    def close(self):
+        # Release the memory map, files cannot be replaced while mapped on Windows.
+        self.heights = None
 
 
 def visualize(audio,
@@ -202,12 +1874,27 @@ def visualize(audio,
               center=(.5, .5),
               size=(400, 300),
               stereo=False,
+              renderer='cairo',
+              workers=1,
+              segments=1,
+              profile='default',
+              encoder_options=None,
+              dedup=0.,
+              analysis_tolerance=None,
+              verbose=True,
+              cache_dir=None,
               progress_callback=None,
               frame_callback=None,
+              stage_callback=None,
+              cancel=None,
+              metrics=None,
+              cprofile=None,
+              frame_store=None,
               ):
     """
-    Generate the visualisation for the `audio` file, using a `tmp` folder and saving the final
-    video in `out`.
+    Generate the visualisation for the `audio` file and save the final video in `out`.
+    Frames are streamed directly to ffmpeg, `tmp` is not used anymore and is only kept
+    for backward compatibility (it can be None).
     `seek` and `durations` gives the extract location if any.
     `rate` is the framerate of the output video.
 
@@ -222,96 +1909,148 @@ def visualize(audio,
     `bg_image` is the path to the PNG image to use for the background.
     `size` is the `(width, height)` in pixels to generate.
     `stereo` is whether to create 2 waves.
-    `progress_callback` is a function that takes a percentage value (0-100) to report progress.
-    `frame_callback` is a function that reports current frame and total frames.
+    `renderer` is the name of the backend drawing the frames, one of `RENDERERS`.
+    `workers` is the number of processes used to render the frames. Output is identical
+        whatever the number of workers.
+    `segments` is the number of chunks the video is split into, each one being rendered and
+        encoded by one of the `workers`, see `render_segments`. Interrupted renders can be
+        resumed from the completed segments.
+    `profile` is the name of the encoder profile, see `ENCODER_PROFILES`.
+    `encoder_options` is a dict overriding some of the profile settings, see
+        `encoder_settings`.
+    `dedup` is the maximum change of the bar heights below which a frame is not rendered
+        again, but encoded as a copy of the previous one. The default only skips exact
+        duplicates (e.g. silences), None disables it.
+    `analysis_tolerance` is how much the envelope can differ from the one extracted at the
+        native sample rate for the audio to be analysed at a reduced rate instead, see
+        `select_analysis_rate`, e.g. 0.02. None (the default) always uses the native rate.
+    `verbose` controls the messages and progress bar printed on the terminal.
+    `cache_dir` is where to cache the envelopes and media info of the audio (see
+        `cached_envelopes` and `read_info`), None to disable caching on disk.
+    `progress_callback` is a function that takes a percentage value (0-100) to report progress,
+        weighted by the measured duration of each stage, see `RenderProgress`.
+    `frame_callback` is a function that reports current frame and total frames. It is first
+        called with 0 frames once the exact number of frames is known.
+    `stage_callback` is a function called with the progress of each stage of the render
+        (`analysis`, `frames`, then `encode`, or `mux` with `segments`) in its own unit,
+        along with the overall percentage and the estimated time left, see `RenderProgress`.
+    `cancel` is a `CancelToken` that can interrupt the render from another thread. ffmpeg
+        processes are killed right away, the incomplete video is removed (completed
+        `segments` are kept for later) and `Cancelled` is raised.
+    `metrics` is a `Metrics` instance, or a function called with each of its events, timing
+        the stages of the render, the latency of the frames (when not using `segments`),
+        the data piped to ffmpeg and the time spent waiting for it.
+    `cprofile` is a path where to save the cProfile statistics of the render (e.g. to open
+        with `pstats` or snakeviz), None to not profile it.
+    `frame_store` is a path where to keep the bar heights of every frame, see `FrameStore`.
+        Once complete, rendering again the same audio with the same analysis parameters
+        (e.g. with other colors, size or encoder settings) reads them instead of analysing
+        the audio, frames are still drawn and encoded. None to not store them.
+
+    Returns a dict with the number of `frames`, the `duration` in seconds of the video and
+    the number of frames that were `skipped` thanks to `dedup`, plus the `metrics`
+    summary (see `Metrics.summary`) if `metrics` is given.
     """
+    if cprofile is not None:
+        kwargs = {key: value for key, value in locals().items() if key != 'cprofile'}
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(visualize, **kwargs)
+        finally:
+            profiler.dump_stats(str(cprofile))
+    if cancel is None:
+        cancel = CancelToken()
+    report = metrics is not None
+    if not isinstance(metrics, Metrics):
+        metrics = Metrics(metrics)
+
+    reported = [None]
+
+    def on_update(state):
+        if stage_callback:
+            stage_callback(state)
+        percent = int(state['percent'])
+        if progress_callback and percent != reported[0]:
+            reported[0] = percent
+            progress_callback(percent)
+
+    # Totals are estimated from the media info until the audio is decoded.
     try:
-        if progress_callback:
-            progress_callback(5)
-        wav, sr = read_audio(audio, seek=seek, duration=duration)
+        plan = render_plan(audio, seek=seek, duration=duration, rate=rate, cache_dir=cache_dir)
     except (IOError, ValueError) as err:
         fatal(err)
         raise
+    except KeyError:
+        plan = {'duration': 0., 'frames': 0}
+    progress = RenderProgress([
+        ('analysis', plan['duration'], 's'),
+        ('frames', plan['frames'], 'frames'),
+        ('mux', plan['duration'], 's') if segments > 1 else ('encode', plan['frames'], 'frames'),
+    ], on_update)
+    progress.update('analysis', 0)
 
     output_size = size
     image = None
     if bg_image is not None:
         try:
-            image = Image.open(bg_image)
+            with metrics.stage('background'):
+                image = load_background(bg_image)
         except (IOError, ValueError) as err:
             fatal(err)
             raise
-        # resize image to be compatible with ffmpeg
-        if image.width % 2 == 1:
-            image = image.resize(image.width + 1, image.height)
-        if image.height % 2 == 1:
-            image = image.resize(image.width, image.height + 1)
         output_size = image.width, image.height
 
-    if progress_callback:
-        progress_callback(10)
+    store = None
+    if frame_store is not None:
+        stat = os.stat(audio)
+        store_params = {
+            'audio': os.path.abspath(audio), 'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+            'seek': seek, 'duration': duration, 'rate': rate, 'bars': bars, 'speed': speed,
+            'time': time, 'oversample': oversample, 'stereo': stereo,
+            'analysis_tolerance': analysis_tolerance,
+        }
+        store = FrameStore.load(frame_store, store_params)
 
-    # wavs is a list of wav over channels
-    wavs = []
-    if stereo:
-        assert wav.shape[0] == 2, 'stereo requires stereo audio file'
-        wavs.append(wav[0])
-        wavs.append(wav[1])
+    envs = sr = stride = None
+    if store is not None and store.complete:
+        # The bar heights of all the frames are known, no need to analyse the audio again.
+        duration = store.duration
+        frames = store.frames
+        progress.update('analysis', plan['duration'])
+        if verbose:
+            print(f"Reusing the bar heights of the {frames} frames stored in {frame_store}.")
     else:
-        wav = wav.mean(0)
-        wavs.append(wav)
-
-    for i, wav in enumerate(wavs):
-        wavs[i] = wav/wav.std()
-
-    if progress_callback:
-        progress_callback(20)
-
-    window = int(sr * time / bars)
-    stride = int(window / oversample)
-    # envs is a list of env over channels
-    envs = []
-    for wav in wavs:
-        env = envelope(wav, window, stride)
-        env = np.pad(env, (bars // 2, 2 * bars))
-        envs.append(env)
-
-    if progress_callback:
-        progress_callback(30)
-
-    duration = len(wavs[0]) / sr
-    frames = int(rate * duration)
-    smooth = np.hanning(bars)
-
-    print("Generating the frames...")
-    for idx in tqdm.tqdm(range(frames), unit=" frames", ncols=80):
-        pos = (((idx / rate)) * sr) / stride / bars
-        off = int(pos)
-        loc = pos - off
-        denvs = []
-        for env in envs:
-            env1 = env[off * bars:(off + 1) * bars]
-            env2 = env[(off + 1) * bars:(off + 2) * bars]
-
-            # we want loud parts to be updated faster
-            maxvol = math.log10(1e-4 + env2.max()) * 10
-            speedup = np.clip(interpole(-6, 0.5, 0, 2, maxvol), 0.5, 2)
-            w = sigmoid(speed * speedup * (loc - 0.5))
-            denv = (1 - w) * env1 + w * env2
-            denv *= smooth
-            denvs.append(denv)
-        draw_env(denvs, tmp / f"{idx:06d}.png", (fg_color, fg_color2), fg_opacity, bg_color, image, center, size)
-        
-        # Track progress with frames
-        if frame_callback:
-            frame_callback(idx + 1, frames)
-            
-        if progress_callback and idx % (frames // 50) == 0:  # Update progress ~50 times
-            progress = 30 + int(50 * idx / frames)
-            progress_callback(progress)
+        # The audio is decoded and analysed block by block, without holding it in memory.
+        try:
+            with metrics.stage('analysis'):
+                envs, sr, length = cached_envelopes(audio, bars, time, oversample,
+                                                    seek=seek, duration=duration, stereo=stereo,
+                                                    cache_dir=cache_dir,
+                                                    analysis_tolerance=analysis_tolerance,
+                                                    cancel=cancel,
+                                                    on_progress=lambda done: progress.update(
+                                                        'analysis', done))
+        except (IOError, ValueError) as err:
+            fatal(err)
+            raise
+        window, stride = analysis_window(sr, time, bars, oversample)
+        # envs is a list of env over channels
+        envs = [np.pad(env, (bars // 2, 2 * bars)) for env in envs]
 
-    if progress_callback:
-        progress_callback(80)
+        duration = length / sr
+        frames = int(rate * duration)
+        if frame_store is not None:
+            if store is None or store.heights.shape != (frames, len(envs), bars):
+                store = FrameStore.create(frame_store, store_params, frames, len(envs), bars,
+                                          duration)
+            elif verbose and store.written:
+                print(f"Completing the frame store {frame_store}, "
+                      f"{store.written} frames were already stored.")
+    progress.set_total('frames', frames)
+    if segments > 1:
+        progress.set_total('mux', duration)
+    else:
+        progress.set_total('encode', frames)
 
     audio_cmd = []
     if seek is not None:
@@ -322,32 +2061,1000 @@ def visualize(audio,
     audio_cmd += ["-i", str(audio.resolve())]
     if duration is not None:
         audio_cmd += ["-t", str(duration)]
-    print("Encoding the animation video... ")
-    # https://hamelot.io/visualization/using-ffmpeg-to-convert-a-set-of-images-into-a-video/
-    
-    # Set subprocess flags based on platform
-    extra_args = {}
-    if platform.system() == 'Windows':
-        extra_args = {'creationflags': CREATE_NO_WINDOW}
-    
-    sp.run([
-        "ffmpeg", "-y",
-        "-loglevel", "panic", "-r",
-        str(rate), "-f", "image2", "-s", f"{output_size[0]}x{output_size[1]}", "-i", "%06d.png"
-    ] + audio_cmd + [
-        "-c:a", "aac",
-         "-vcodec", "libx264",
-         "-crf", "10", "-pix_fmt", "yuv420p",
-        "-threads", "8",
-        "-preset", "veryfast",
-        str(out.resolve())
-    ],
-           check=True,
-           cwd=tmp,
-           **extra_args)
 
-    if progress_callback:
-        progress_callback(100)
+    try:
+        settings = encoder_settings(profile, **(encoder_options or {}))
+    except ValueError as err:
+        fatal(err)
+        raise
+    if segments > 1 and not settings['gop']:
+        # Segments must start on a keyframe, use a fixed GOP so that they are all aligned.
+        settings['gop'] = max(1, int(round(2 * rate)))
+    video_args, audio_args = encoder_args(settings)
+
+    state = {
+        'renderer': renderer,
+        'style': {
+            'fg_colors': (fg_color, fg_color2), 'fg_opacity': fg_opacity, 'bg_color': bg_color,
+            'bg_image': image, 'center': center, 'size': size,
+        },
+    }
+    stats = {'frames': frames, 'duration': duration, 'skipped': 0}
+    # Let callers know the exact number of frames before the first one is rendered.
+    if frame_callback:
+        frame_callback(0, frames)
+
+    if verbose:
+        print("Generating and encoding the frames...")
+    progress_bar = tqdm.tqdm(total=frames, unit=" frames", ncols=80, disable=not verbose)
+
+    def on_frames(done):
+        cancel.check()
+        progress_bar.update(done - progress_bar.n)
+        # Track progress with frames
+        if frame_callback:
+            frame_callback(done, frames)
+        progress.update('frames', done)
+
+    heights = None
+    try:
+        if segments > 1:
+            if store is not None:
+                # Workers read the heights from the store, compute the missing ones first.
+                collections.deque(store.iter_heights(envs, rate, sr, stride, bars, speed),
+                                  maxlen=0)
+            state.update(envs=envs if store is None else None,
+                         frame_store=None if store is None else str(store.path),
+                         sr=sr, stride=stride, bars=bars, rate=rate, speed=speed,
+                         dedup=dedup, frame_size=output_size, video_args=video_args,
+                         gop=settings['gop'])
+            # Segments from a previous run are only reused if they were made for the same render.
+            source = audio.resolve()
+            fingerprint = json.dumps([
+                str(source), os.stat(source).st_mtime_ns, seek, duration, rate, bars, speed,
+                time, oversample, fg_color, fg_color2, fg_opacity, bg_color, bg_image, center,
+                size, stereo, renderer, dedup, analysis_tolerance, video_args,
+            ], default=str)
+            with metrics.stage('segments'):
+                render_segments(state, frames, out, audio_cmd + audio_args, segments, workers,
+                                fingerprint, stats=stats, on_frames=on_frames, cancel=cancel,
+                                on_mux=lambda done: progress.update('mux', done))
+        else:
+            # Frames are streamed as raw BGRA buffers to a single ffmpeg process, so that
+            # rendering and encoding overlap.
+            command = [
+                "ffmpeg", "-y",
+                "-loglevel", "panic",
+            ] + _raw_input_args(output_size, rate) + audio_cmd + [
+                # The audio file might be a video, only take its first audio stream.
+                "-map", "0:v:0", "-map", "1:a:0",
+            ] + audio_args + video_args + [
+                str(out.resolve())
+            ]
+            if store is None:
+                heights = iter_bar_heights(envs, frames, rate, sr, stride, bars, speed)
+            else:
+                heights = store.iter_heights(envs, rate, sr, stride, bars, speed)
+            rendered = render_frames(state, heights, workers, dedup=dedup, stats=stats)
+            with metrics.stage('frames'):
+                _pipe_frames(command, rendered, lambda idx: on_frames(idx + 1), cancel=cancel,
+                             metrics=metrics,
+                             on_encoded=lambda done: progress.update('encode', done))
+    except Cancelled:
+        # ffmpeg was killed, do not leave a truncated video behind.
+        if out.exists():
+            out.unlink()
+        raise
+    finally:
+        progress_bar.close()
+        if store is not None:
+            if heights is not None:
+                # Records the frames computed so far in the store.
+                heights.close()
+            store.close()
+
+    if verbose and stats['skipped']:
+        print(f"Skipped rendering {stats['skipped']} unchanged frames out of {frames}.")
+    if report:
+        stats['metrics'] = metrics.summary()
+        metrics.emit('summary', **stats['metrics'])
+    progress.finish()
+    return stats
+
+
+class FramePreview:
+    """
+    Render single frames of the visualisation of `audio` at any position, without
+    encoding anything, e.g. for a live preview synced to the audio playback.
+    The envelope is computed once (and cached in `cache_dir`, so that a full render with
+    the same analysis parameters reuses it), each frame then only costs its bar heights
+    and drawing. Frames are rendered at `scale` times the resolution of the video,
+    other arguments are the same as for `visualize`.
+    """
+
+    def __init__(self, audio, scale=0.25, rate=60, bars=50, speed=4, time=0.4, oversample=3,
+                 fg_color=(.2, .2, .2), fg_color2=(.5, .3, .6), fg_opacity=1,
+                 bg_color=(1, 1, 1), bg_image=None, center=(.5, .5), size=(400, 300),
+                 stereo=False, renderer='cairo', cache_dir=None, analysis_tolerance=None):
+        self.rate = rate
+        self.bars = bars
+        self.speed = speed
+        envs, self.sr, length = cached_envelopes(audio, bars, time, oversample, stereo=stereo,
+                                                 cache_dir=cache_dir,
+                                                 analysis_tolerance=analysis_tolerance)
+        _, self.stride = analysis_window(self.sr, time, bars, oversample)
+        self.envs = [np.pad(env, (bars // 2, 2 * bars)) for env in envs]
+        self.duration = length / self.sr
+        self.frames = int(rate * self.duration)
+
+        image = None
+        size = (max(2, int(size[0] * scale)), max(2, int(size[1] * scale)))
+        if bg_image is not None:
+            image = load_background(bg_image)
+            image = image.resize((max(2, int(image.width * scale)),
+                                  max(2, int(image.height * scale))))
+        self.size = size if image is None else (image.width, image.height)
+        self.renderer = RENDERERS[renderer](
+            (fg_color, fg_color2), fg_opacity, bg_color, image, center, size, buffers=1)
+
+    def heights(self, position):
+        """
+        Return the bar heights `float[channels, bars]` of the frame shown at `position`
+        seconds.
+        """
+        idx = min(max(0, int(position * self.rate)), max(0, self.frames - 1))
+        return bar_heights(self.envs, [idx], self.rate, self.sr, self.stride, self.bars,
+                           self.speed)[0]
+
+    def render(self, position):
+        """
+        Return the raw BGRA pixels (premultiplied, `self.size`) of the frame shown at
+        `position` seconds. The buffer is reused by the next call.
+        """
+        return self.renderer.render(self.heights(position))
+
+
+def synthetic_audio(path, duration, kind='sweep', samplerate=44100, channels=2, seed=0):
+    """
+    Write `duration` seconds of synthetic audio to the WAV file `path`, so that renders
+    can be timed without any audio file at hand. `kind` is one of `SYNTHETIC_AUDIO`:
+    a logarithmic sine `sweep` from 50 Hz to 10 kHz, `noise` with a slowly varying
+    volume or `silence`.
+    """
+    if kind not in SYNTHETIC_AUDIO:
+        raise ValueError(f"Unknown synthetic audio {kind}, "
+                         f"should be one of {', '.join(SYNTHETIC_AUDIO)}.")
+    t = np.arange(int(duration * samplerate)) / samplerate
+    if kind == 'sweep':
+        low, high = 50, 10000
+        rate = math.log(high / low) / max(duration, 1e-3)
+        wav = 0.5 * np.sin(2 * math.pi * low * np.expm1(rate * t) / rate)
+    elif kind == 'noise':
+        rng = np.random.default_rng(seed)
+        volume = 0.5 + 0.5 * np.sin(2 * math.pi * 0.5 * t) ** 2
+        wav = 0.3 * volume * rng.standard_normal(len(t))
+    else:
+        wav = np.zeros_like(t)
+    pcm = (np.clip(wav, -1, 1) * 32767).astype('<i2')
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes(np.repeat(pcm[:, None], channels, axis=1).tobytes())
+
+
+SYNTHETIC_AUDIO = ('sweep', 'noise', 'silence')
+
+
+def _calibration_key(params):
+    """
+    Internal function, identify a calibration with the arguments `params` of `calibrate`
+    on this machine, with this version of Python, of seewav (the hash of its source, or
+    the frozen executable) and of ffmpeg (its path and modification time).
+    """
+    try:
+        with open(__file__, 'rb') as f:
+            version = hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        version = [sys.executable, os.stat(sys.executable).st_mtime_ns]
+    ffmpeg = shutil.which('ffmpeg')
+    key = {
+        'params': params, 'seewav': version, 'python': sys.version,
+        'machine': [platform.platform(), platform.machine(), platform.processor(),
+                    os.cpu_count()],
+        'ffmpeg': [ffmpeg, os.stat(ffmpeg).st_mtime_ns if ffmpeg else None],
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def calibrate(profile='default', renderer='cairo', bars=(50, 200), rate=30, duration=2.,
+              sizes=((480, 270), (960, 540)), cache_dir=None):
+    """
+    Time the render of `duration` seconds of synthetic audio at each of the `sizes` with
+    the first number of `bars`, then at the first size with the last number of bars, to
+    estimate how long renders take on this machine with the given encoder `profile` and
+    `renderer`, see `estimate_render_time`.
+    Returns the cost of a frame as a fixed part `frame`, plus a part `pixel` proportional
+    to its number of pixels and a part `bar` proportional to its number of bars, in
+    seconds. If `cache_dir` is not None, the result is stored there and reused as long
+    as the machine and the versions of seewav, Python and ffmpeg are the same.
+    """
+    stored = None
+    if cache_dir is not None:
+        params = [profile, renderer, list(bars), rate, duration, [list(size) for size in sizes]]
+        stored = Path(cache_dir) / 'calibrations' / f"{_calibration_key(params)}.json"
+        try:
+            with open(stored, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    runs = [(size, bars[0]) for size in sizes]
+    if bars[-1] != bars[0]:
+        runs.append((sizes[0], bars[-1]))
+    with tempfile.TemporaryDirectory() as tmp:
+        audio = Path(tmp) / 'calibration.wav'
+        synthetic_audio(audio, duration, 'noise')
+        costs = []
+        for size, count in runs:
+            begin = time.perf_counter()
+            stats = visualize(audio, None, Path(tmp) / 'calibration.mp4', rate=rate, bars=count,
+                              size=size, renderer=renderer, profile=profile, verbose=False,
+                              analysis_tolerance=None)
+            elapsed = time.perf_counter() - begin
+            costs.append(elapsed / max(1, stats['frames']))
+    pixels1, pixels2 = sizes[0][0] * sizes[0][1], sizes[-1][0] * sizes[-1][1]
+    pixel = max(0., (costs[len(sizes) - 1] - costs[0]) / (pixels2 - pixels1)) \
+        if pixels2 != pixels1 else 0.
+    bar = max(0., (costs[-1] - costs[0]) / (bars[-1] - bars[0])) if bars[-1] != bars[0] else 0.
+    frame = max(0., costs[0] - pixel * pixels1 - bar * bars[0])
+    calibration = {'frame': frame, 'pixel': pixel, 'bar': bar}
+    if stored is not None:
+        try:
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = stored.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(calibration, f)
+            os.replace(tmp_path, stored)
+        except OSError as err:
+            print(f"Warning: could not write to the calibration cache: {err}", file=sys.stderr)
+    return calibration
+
+
+def estimate_render_time(calibration, duration, rate, size, bars=50):
+    """
+    Estimate the time in seconds it takes to render `duration` seconds of audio at the
+    frame `rate` and `size` with that many `bars`, from the result of `calibrate`.
+    """
+    frames = int(rate * duration)
+    return frames * (calibration['frame'] + calibration['pixel'] * size[0] * size[1]
+                     + calibration['bar'] * bars)
+
+
+def _run_batch_job(job, **kwargs):
+    """
+    Internal function, run a single batch `job` in a worker process and return its status.
+    The video is first written next to its final location and only renamed once complete,
+    so that a crash never leaves a truncated output behind. `kwargs` (e.g. callbacks)
+    are passed to `visualize`.
+    """
+    options = dict(job['options'])
+    out = Path(job['out'])
+    partial = out.with_name(out.stem + '.partial' + out.suffix)
+    status = {'id': job['id'], 'audio': job['audio'], 'out': job['out']}
+    begin = time.time()
+    try:
+        out.parent.mkdir(parents=True, exist_ok=True)
+        options.setdefault('workers', 1)
+        visualize(Path(job['audio']), None, partial, verbose=False, **options, **kwargs)
+        os.replace(partial, out)
+    except Exception as err:
+        status.update(status='error', error=str(err))
+        if partial.exists():
+            partial.unlink()
+    else:
+        status['status'] = 'ok'
+    status['elapsed'] = time.time() - begin
+    return status
+
+
+# Options of `visualize` which are paths, relative to the manifest in a batch job.
+_PATH_OPTIONS = ('bg_image', 'cache_dir', 'cprofile', 'frame_store')
+
+
+def read_manifest(manifest):
+    """
+    Read a batch `manifest`, a JSON lines file with one job per line. Each job must have
+    an `audio` and an `out` entry, an optional `id` (defaults to `out`), all other entries
+    are passed as keyword arguments to `visualize`. Relative paths (`audio`, `out` and the
+    `_PATH_OPTIONS`) are relative to the manifest. Jobs run in daemonic pool workers,
+    which cannot start processes of their own, so `workers` must be 1 (`segments` are
+    then rendered one after the other), parallelism comes from the number of `jobs` of
+    `batch`.
+    """
+    manifest = Path(manifest)
+    root = manifest.resolve().parent
+    jobs = []
+    with open(manifest, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                options = json.loads(line)
+                audio = root / options.pop('audio')
+                out = root / options.pop('out')
+            except (ValueError, KeyError) as err:
+                raise ValueError(f"{manifest}:{lineno}: invalid job, {err}") from err
+            if options.get('workers', 1) != 1:
+                raise ValueError(f"{manifest}:{lineno}: invalid job, batch jobs cannot use "
+                                 "'workers', use the --jobs option of batch instead")
+            for key in _PATH_OPTIONS:
+                if options.get(key) is not None:
+                    options[key] = str(root / options[key])
+            job_id = str(options.pop('id', out))
+            jobs.append({'id': job_id, 'audio': str(audio), 'out': str(out), 'options': options})
+    return jobs
+
+
+def batch(manifest, results=None, jobs=1, cache_dir=None):
+    """
+    Render all the jobs from the `manifest` (see `read_manifest`) using a pool of `jobs`
+    worker processes, each one rendering many files, so that imports and background
+    images are only loaded once per worker.
+    The status and timing of each job is appended to `results` as JSON lines
+    (defaults to the manifest path with a `.results.jsonl` suffix). Jobs that already
+    completed successfully in a previous run, and whose output still exists, are skipped.
+    `cache_dir` is used by jobs that do not specify one, see `visualize`. Media info of
+    all the files is then probed in parallel before rendering.
+    Returns the number of failed jobs.
+    """
+    manifest = Path(manifest)
+    if results is None:
+        results = manifest.with_suffix('.results.jsonl')
+    results = Path(results)
+
+    done = set()
+    if results.exists():
+        with open(results, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    status = json.loads(line)
+                except ValueError:
+                    # Last line might be truncated if we crashed while writing it.
+                    continue
+                if status.get('status') == 'ok' and Path(status['out']).exists():
+                    done.add(status['id'])
+
+    todo = [job for job in read_manifest(manifest) if job['id'] not in done]
+    print(f"{len(done)} jobs already done, {len(todo)} to render.")
+    if cache_dir is not None:
+        # Workers find the probe results in the on-disk cache, instead of each spawning
+        # ffprobe in turn.
+        for job in todo:
+            job['options'].setdefault('cache_dir', str(cache_dir))
+        prefetch_info([job['audio'] for job in todo], cache_dir=cache_dir)
+    failed = 0
+    with _spawn_context().Pool(max(1, jobs)) as pool, open(results, 'a', encoding='utf-8') as log:
+        statuses = pool.imap_unordered(_run_batch_job, todo)
+        for status in tqdm.tqdm(statuses, total=len(todo), unit=" jobs", ncols=80):
+            if status['status'] != 'ok':
+                failed += 1
+                tqdm.tqdm.write(f"{status['id']}: {status['error']}", file=sys.stderr)
+            log.write(json.dumps(status) + "\n")
+            log.flush()
+    return failed
+
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(
+        'seewav batch', description="Render many audio files listed in a JSON lines manifest.")
+    parser.add_argument("manifest", type=Path,
+                        help="Manifest with one job per line, e.g. "
+                             '{"audio": "a.mp3", "out": "a.mp4", "rate": 30}.')
+    parser.add_argument("--results", type=Path,
+                        help="Where to append the status of each job. "
+                             "Default is the manifest with a .results.jsonl suffix.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of worker processes, each rendering one file at a time.")
+    parser.add_argument("--cache-dir", type=Path, default=default_cache_dir(),
+                        help="Where to cache the analysis of audio files. "
+                             "Default is %(default)s.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not read or write the analysis cache.")
+    args = parser.parse_args(argv)
+    try:
+        failed = batch(args.manifest, args.results, args.jobs,
+                       cache_dir=None if args.no_cache else args.cache_dir)
+    except (IOError, ValueError) as err:
+        fatal(err)
+        raise
+    if failed:
+        fatal(f"{failed} jobs failed.")
+
+
+class RenderJob:
+    """
+    A render submitted to a `RenderQueue`. Its progress is recorded as a list of events
+    (dicts with an `event` name, a `time` and extra entries) that clients can follow with
+    `iter_events`. The `progress_callback`, `frame_callback`, `stage_callback` and
+    `metrics_callback` methods, as well as the `CancelToken` `token`, are given to
+    `visualize`. The latest state of the current stage, with the estimated time left, is
+    kept in `progress`.
+    """
+
+    FINAL = ('done', 'error', 'cancelled')
+
+    def __init__(self, job_id, audio, out, options, priority=0):
+        self.id = job_id
+        self.audio = audio
+        self.out = out
+        self.options = options
+        self.priority = priority
+        self.status = 'queued'
+        self.result = None
+        self.token = CancelToken()
+        self.events = []
+        self.progress = None
+        self._percent = None
+        self._cond = threading.Condition()
+        self.emit('queued')
+
+    def emit(self, event, **data):
+        with self._cond:
+            if event == 'started':
+                self.status = 'running'
+            elif event in self.FINAL:
+                self.status = event
+            self.events.append(dict(data, event=event, id=self.id, time=time.time()))
+            self._cond.notify_all()
+
+    @property
+    def cancelled(self):
+        return self.token.cancelled
+
+    def cancel(self):
+        self.token.cancel()
+
+    def progress_callback(self, value):
+        self.emit('progress', progress=value)
+
+    def frame_callback(self, frame, frames):
+        # At most one event per percent, so the history stays small for long videos.
+        percent = int(100 * frame / frames) if frames else 100
+        if percent != self._percent:
+            self._percent = percent
+            self.emit('frame', frame=frame, frames=frames)
+
+    def stage_callback(self, state):
+        # Only the start of each stage is an event, `describe` gives the latest state.
+        if self.progress is None or self.progress['stage'] != state['stage']:
+            self.emit('stage', stage=state['stage'], total=state['total'], unit=state['unit'],
+                      eta=state['eta'])
+        self.progress = state
+
+    def metrics_callback(self, event):
+        # Stage timings and the final summary are part of the events of the job.
+        event = dict(event)
+        self.emit(event.pop('event'), **event)
+
+    def iter_events(self, timeout=None):
+        """
+        Yield all the events of the job, past and future, until it is finished.
+        Stops early if no event came within `timeout` seconds.
+        """
+        index = 0
+        while True:
+            with self._cond:
+                if index >= len(self.events):
+                    if self.status in self.FINAL:
+                        return
+                    if not self._cond.wait(timeout) and index >= len(self.events):
+                        return
+                pending = self.events[index:]
+            index += len(pending)
+            yield from pending
+
+    def describe(self):
+        return {
+            'id': self.id, 'audio': self.audio, 'out': self.out, 'priority': self.priority,
+            'status': self.status, 'result': self.result, 'progress': self.progress,
+        }
+
+
+# Options of `visualize` that can be given to a job of `serve`.
+_JOB_OPTIONS = set(visualize.__code__.co_varnames[:visualize.__code__.co_argcount]) - {
+    'audio', 'tmp', 'out', 'verbose', 'progress_callback', 'frame_callback', 'stage_callback',
+    'cancel', 'metrics'}
+
+
+class RenderQueue:
+    """
+    Run render jobs submitted with `submit` on `jobs` threads, highest `priority` first,
+    then in submission order. At most `max_queue` jobs can wait, `submit` raises
+    `queue.Full` beyond that so that clients back off instead of piling up work.
+    `cache_dir` is used by jobs that do not specify one, see `visualize`.
+    The `keep` most recent finished jobs are remembered for status queries.
+    """
+
+    def __init__(self, jobs=2, max_queue=64, cache_dir=None, keep=1000):
+        self.max_queue = max_queue
+        self.cache_dir = cache_dir
+        self.keep = keep
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._threads = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(max(1, jobs))]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, spec):
+        """
+        Queue the render described by `spec`, a dict in the same format as a line of a
+        batch manifest (see `read_manifest`), with an optional `priority`.
+        Returns the `RenderJob`. Raises ValueError if `spec` is invalid.
+        """
+        spec = dict(spec)
+        try:
+            audio = str(Path(spec.pop('audio')).resolve())
+            out = str(Path(spec.pop('out')).resolve())
+            priority = float(spec.pop('priority', 0))
+        except (KeyError, TypeError, ValueError) as err:
+            raise ValueError(f"invalid job, {err}") from err
+        job_id = str(spec.pop('id', None) or uuid.uuid4().hex[:12])
+        unknown = set(spec) - _JOB_OPTIONS
+        if unknown:
+            raise ValueError(f"invalid job, unknown options {sorted(unknown)}")
+        if self.cache_dir is not None:
+            spec.setdefault('cache_dir', str(self.cache_dir))
+        with self._lock:
+            if job_id in self._jobs:
+                raise ValueError(f"invalid job, id {job_id} already exists")
+            if self._queued >= self.max_queue:
+                raise queue.Full(f"{self._queued} jobs are already waiting")
+            job = RenderJob(job_id, audio, out, spec, priority)
+            self._jobs[job_id] = job
+            self._queued += 1
+            self._forget()
+        self._queue.put((-priority, next(self._counter), job))
+        return job
+
+    def get(self, job_id):
+        """
+        Return the job with the given id, or None.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Cancel the job with the given id. A waiting job is dropped right away, the ffmpeg
+        processes of a running one are killed. Returns the job, or None.
+        """
+        job = self.get(job_id)
+        if job is not None and job.status not in RenderJob.FINAL:
+            job.cancel()
+            with self._lock:
+                if job.status == 'queued':
+                    self._queued -= 1
+                    job.emit('cancelled')
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self._queued, 'running': self._running,
+                    'workers': len(self._threads), 'max_queue': self.max_queue}
+
+    def _forget(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in RenderJob.FINAL]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            with self._lock:
+                if job.cancelled:
+                    continue
+                self._queued -= 1
+                self._running += 1
+                job.emit('started')
+            try:
+                status = _run_batch_job(
+                    {'id': job.id, 'audio': job.audio, 'out': job.out, 'options': job.options},
+                    progress_callback=job.progress_callback,
+                    frame_callback=job.frame_callback,
+                    stage_callback=job.stage_callback,
+                    metrics=job.metrics_callback,
+                    cancel=job.token)
+            finally:
+                with self._lock:
+                    self._running -= 1
+            job.result = status
+            if status['status'] == 'ok':
+                job.emit('done', elapsed=status['elapsed'])
+            elif job.cancelled:
+                status['status'] = 'cancelled'
+                job.emit('cancelled', latency=job.token.latency)
+            else:
+                job.emit('error', error=status['error'])
+
+
+class _RenderRequestHandler:
+    """
+    HTTP API of `serve`, see `serve_main`. Mixed with `BaseHTTPRequestHandler` by `serve`,
+    so that http.server is only imported when serving.
+    """
+
+    def _send_json(self, code, data, headers=None):
+        body = (json.dumps(data) + "\n").encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        job = None
+        if len(parts) >= 2 and parts[0] == 'jobs':
+            job = self.server.render_queue.get(parts[1])
+            if job is None:
+                self._send_json(404, {'error': f"no job {parts[1]}"})
+                return None, None
+        return parts, job
+
+    def do_GET(self):
+        parts, job = self._route()
+        if parts is None:
+            return
+        render_queue = self.server.render_queue
+        if parts == ['health']:
+            self._send_json(200, render_queue.stats())
+        elif parts == ['jobs']:
+            self._send_json(200, [job.describe() for job in render_queue.jobs()])
+        elif len(parts) == 2 and job is not None:
+            self._send_json(200, job.describe())
+        elif len(parts) == 3 and parts[2] == 'events' and job is not None:
+            # One JSON event per line, until the job is finished.
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            try:
+                for event in job.iter_events():
+                    self.wfile.write((json.dumps(event) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            spec = json.loads(self.rfile.read(length) or b'null')
+            if not isinstance(spec, dict):
+                raise ValueError("a job must be a JSON object")
+            job = self.server.render_queue.submit(spec)
+        except queue.Full as err:
+            self._send_json(503, {'error': f"queue is full, {err}"}, {'Retry-After': '5'})
+        except ValueError as err:
+            self._send_json(400, {'error': str(err)})
+        else:
+            self._send_json(202, job.describe())
+
+    def do_DELETE(self):
+        parts, job = self._route()
+        if parts is None:
+            return
+        if len(parts) == 2 and job is not None:
+            self._send_json(200, self.server.render_queue.cancel(job.id).describe())
+        else:
+            self._send_json(404, {'error': f"unknown path {self.path}"})
+
+    def address_string(self):
+        # Unix sockets have no client address.
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(render_queue, host='127.0.0.1', port=8765, socket=None, verbose=False,
+          on_ready=None):
+    """
+    Serve the HTTP API to submit jobs to `render_queue` on `host:port`, or on the Unix
+    socket at path `socket` if given, until interrupted or until `shutdown` is called on
+    the server. `on_ready` (if not None) is called with the server once it listens, e.g.
+    to know the port it got when `port` is 0. See `serve_main` for the API.
+    """
+    class RenderRequestHandler(_RenderRequestHandler, http.server.BaseHTTPRequestHandler):
+        pass
+
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if socket is not None:
+        if os.path.exists(socket):
+            os.unlink(socket)
+        server = UnixHTTPServer(str(socket), RenderRequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), RenderRequestHandler)
+    server.render_queue = render_queue
+    server.verbose = verbose
+    address = socket if socket is not None else "http://%s:%d" % server.server_address[:2]
+    print(f"seewav is listening on {address}", file=sys.stderr, flush=True)
+    if on_ready is not None:
+        on_ready(server)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for job in render_queue.jobs():
+            render_queue.cancel(job.id)
+        if socket is not None and os.path.exists(socket):
+            os.unlink(socket)
+
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(
+        'seewav serve',
+        description="Run a render server, so that each render does not pay the startup cost.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""API, all bodies are JSON:
+  POST   /jobs              submit a job, same format as a batch manifest line plus an
+                            optional "priority" (higher first). 503 if the queue is full.
+  GET    /jobs              list the jobs.
+  GET    /jobs/ID           status of a job.
+  GET    /jobs/ID/events    stream the progress events of a job, one per line.
+  DELETE /jobs/ID           cancel a job.
+  GET    /health            number of queued and running jobs.""")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on. Default is %(default)s.")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port to listen on. Default is %(default)s.")
+    parser.add_argument("--socket", type=Path,
+                        help="Listen on this Unix socket instead of TCP.")
+    parser.add_argument("-j", "--jobs", type=int, default=2,
+                        help="Number of jobs rendered at the same time.")
+    parser.add_argument("--max-queue", type=int, default=64,
+                        help="Number of waiting jobs above which new ones are refused.")
+    parser.add_argument("--cache-dir", type=Path, default=default_cache_dir(),
+                        help="Where to cache the analysis of audio files. "
+                             "Default is %(default)s.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not read or write the analysis cache.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Log every request.")
+    args = parser.parse_args(argv)
+    global _is_main
+    # Errors of a job are reported to its clients, they must not exit the server.
+    _is_main = False
+    # The server runs for long, jobs should not wait for the deferred imports.
+    _preload(np, Image, tqdm, cairo if has_cairo() else None)
+    render_queue = RenderQueue(args.jobs, args.max_queue,
+                               cache_dir=None if args.no_cache else args.cache_dir)
+    serve(render_queue, args.host, args.port, args.socket, args.verbose)
+
+
+def _peak_rss():
+    """
+    Internal function, return the peak resident memory of this process in bytes, or None
+    if unknown on this platform. ffmpeg is not included, as Linux reports the memory of
+    the parent at fork time for children.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Budget in seconds for `import seewav` in a fresh interpreter, see `startup_time`.
+STARTUP_BUDGET = 0.1
+
+
+def startup_time(module='seewav', runs=5):
+    """
+    Measure the import of `module` in a fresh interpreter with `python -X importtime`,
+    keeping the fastest of `runs`. Returns a dict with the `seconds` it took and the
+    `imports` it made directly, as `[name, seconds]` (including their own imports) from
+    the slowest.
+    """
+    best = None
+    for _ in range(runs):
+        proc = sp.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                      capture_output=True, text=True, check=True,
+                      cwd=os.path.dirname(os.path.abspath(__file__)), **_subprocess_args())
+        imports = []
+        seconds = None
+        # Lines are "import time: self [us] | cumulative [us] | name", indented by depth,
+        # each module coming after the ones it imported.
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            depth = len(name) - len(name.lstrip())
+            if depth == 1:
+                if name.strip() == module:
+                    seconds = int(cumulative) / 1e6
+                    break
+                imports = []
+            elif depth == 3:
+                imports.append([name.strip(), int(cumulative) / 1e6])
+        if seconds is not None and (best is None or seconds < best['seconds']):
+            imports.sort(key=lambda item: item[1], reverse=True)
+            best = {'seconds': seconds, 'imports': imports}
+    return best
+
+
+def bench_case(audio, duration, size, bars, rate=30, renderer='cairo', profile='default',
+               time=0.4, oversample=3, speed=4):
+    """
+    Time each stage of the render of the `audio` file (`duration` seconds long) separately:
+    `decode` of the audio, `envelope` extraction, bar `heights` interpolation, frame
+    `render` (drawing only) and `encode` (fed with a sample of the rendered frames), then
+    the whole `visualize` for reference. Other arguments are the same as for `visualize`.
+    Returns a dict with the `seconds` and `throughput` (in the given `unit`) of each stage,
+    and the `peak_rss` memory of the process so far in bytes, which is only the one of
+    this case when run in a fresh process, as `bench` does.
+    """
+    stages = {}
+
+    def stage(name, begin, amount, unit):
+        seconds = perf_counter() - begin
+        stages[name] = {'seconds': seconds, 'throughput': amount / seconds if seconds else None,
+                        'unit': unit}
+
+    # Audio is decoded block by block as in `read_envelopes`, the time spent extracting
+    # the envelope of each block is counted apart from the decoding.
+    begin = perf_counter()
+    blocks, sr = read_audio_blocks(audio)
+    window, stride = analysis_window(sr, time, bars, oversample)
+    extractor = StreamingEnvelope(window, stride)
+    extraction = 0.
+    for block in blocks:
+        start = perf_counter()
+        extractor.push(block.mean(0))
+        extraction += perf_counter() - start
+    start = perf_counter()
+    envs = [np.pad(extractor.finish(), (bars // 2, 2 * bars))]
+    extraction += perf_counter() - start
+    stage('decode', begin + extraction, duration, 'audio seconds/s')
+    stage('envelope', perf_counter() - extraction, duration, 'audio seconds/s')
+
+    frames = int(rate * duration)
+    begin = perf_counter()
+    heights = list(iter_bar_heights(envs, frames, rate, sr, stride, bars, speed))
+    stage('heights', begin, frames, 'frames/s')
+
+    # Keep a bounded sample of the frames to feed the encoder with.
+    step = max(1, frames // 64)
+    sample = []
+    frame_renderer = RENDERERS[renderer](((.2, .2, .2), (.5, .3, .6)), 1., (1., 1., 1.), None,
+                                         (.5, .5), size)
+    begin = perf_counter()
+    for index, row in enumerate(heights):
+        data = frame_renderer.render(row)
+        if index % step == 0:
+            sample.append(bytes(data))
+    stage('render', begin, frames, 'frames/s')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        video_args, _ = encoder_args(encoder_settings(profile))
+        command = [
+            "ffmpeg", "-y",
+            "-loglevel", "panic",
+        ] + _raw_input_args(size, rate) + ["-an"] + video_args + [str(Path(tmp) / 'encode.mp4')]
+        begin = perf_counter()
+        if sample:
+            _pipe_frames(command, (sample[index % len(sample)] for index in range(frames)))
+        stage('encode', begin, frames, 'frames/s')
+        del sample
+
+        begin = perf_counter()
+        visualize(Path(audio), None, Path(tmp) / 'visualize.mp4', rate=rate, bars=bars,
+                  speed=speed, time=time, oversample=oversample, size=size, renderer=renderer,
+                  profile=profile, verbose=False)
+        stage('visualize', begin, frames, 'frames/s')
+    return {'stages': stages, 'frames': frames, 'peak_rss': _peak_rss()}
+
+
+def bench(kinds=SYNTHETIC_AUDIO, durations=(10.,), sizes=((1280, 720), (1920, 1080)),
+          bars=(50,), rate=30, renderer='cairo', profile='default', verbose=True):
+    """
+    Run `bench_case` for each combination of synthetic audio `kinds` (see
+    `synthetic_audio`), `durations`, frame `sizes` and number of `bars`, each one in a
+    fresh process so that its `peak_rss` is not the one of a previous, larger case.
+    Returns a JSON serializable dict with the machine info, the `startup` time (see
+    `startup_time`) against the `STARTUP_BUDGET`, and the list of `results`.
+    """
+    startup = startup_time()
+    if startup is not None:
+        startup['budget'] = STARTUP_BUDGET
+        if verbose:
+            slowest = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in startup['imports'][:3])
+            print(f"import seewav: {startup['seconds']:.3f}s (budget {STARTUP_BUDGET:g}s), "
+                  f"slowest: {slowest}", file=sys.stderr)
+            if startup['seconds'] > STARTUP_BUDGET:
+                print(colorize("warning: ", 1) + "the startup budget is exceeded.", file=sys.stderr)
+    results = []
+    # A fresh process for each case, which does not inherit the memory of this one.
+    pool = _spawn_context().Pool(1, maxtasksperchild=1)
+    with tempfile.TemporaryDirectory() as tmp, pool:
+        for kind in kinds:
+            for duration in durations:
+                audio = Path(tmp) / f"{kind}_{duration}.wav"
+                # Linux keeps the peak memory of the parent in children, even spawned ones,
+                # so this process must not hold the audio either.
+                pool.apply(synthetic_audio, (audio, duration, kind))
+                for size in sizes:
+                    for bar_count in bars:
+                        result = pool.apply(bench_case, (audio, duration, size, bar_count),
+                                            {'rate': rate, 'renderer': renderer,
+                                             'profile': profile})
+                        result.update(kind=kind, duration=duration, size=list(size),
+                                      bars=bar_count, rate=rate, renderer=renderer,
+                                      profile=profile)
+                        results.append(result)
+                        if verbose:
+                            timings = ", ".join(f"{name} {stage['seconds']:.2f}s"
+                                                for name, stage in result['stages'].items())
+                            print(f"{kind} {duration:g}s {size[0]}x{size[1]} {bar_count} bars: "
+                                  f"{timings}", file=sys.stderr)
+    return {
+        'machine': {
+            'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'cpu_count': os.cpu_count(),
+        },
+        'startup': startup,
+        'results': results,
+    }
+
+
+def bench_main(argv):
+    parser = argparse.ArgumentParser(
+        'seewav bench',
+        description="Time each stage of the render of synthetic audio files.")
+    parser.add_argument("--kinds", nargs="+", choices=SYNTHETIC_AUDIO, default=list(SYNTHETIC_AUDIO),
+                        help="Synthetic audio to render.")
+    parser.add_argument("--durations", nargs="+", type=float, default=[10.],
+                        help="Durations of the audio in seconds.")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[(1280, 720), (1920, 1080)],
+                        help="Frame sizes, e.g. 1920x1080.")
+    parser.add_argument("--bars", nargs="+", type=int, default=[50],
+                        help="Number of bars.")
+    parser.add_argument("-r", "--rate", type=int, default=30,
+                        help="Video framerate.")
+    parser.add_argument("--renderer", choices=sorted(RENDERERS), default="cairo",
+                        help="Backend used to draw the frames.")
+    parser.add_argument("-p", "--profile", choices=sorted(ENCODER_PROFILES), default="default",
+                        help="Encoder profile.")
+    parser.add_argument("-o", "--output", type=Path,
+                        help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args(argv)
+    results = bench(args.kinds, args.durations, args.sizes, args.bars, rate=args.rate,
+                    renderer=args.renderer, profile=args.profile)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
 
 
 def parse_color(colorstr):
@@ -373,7 +3080,28 @@ def parse_coords(coordsstr):
         raise
 
 
+def parse_size(sizestr):
+    """
+    Given a width and height in pixels separated by x, returns a tuple of int.
+    """
+    try:
+        width, height = [int(i) for i in sizestr.lower().split("x")]
+        return width, height
+    except ValueError:
+        fatal("Format for sizes is 2 integers separated by x, e.g. 1920x1080")
+        raise
+
+
 def main():
+    if sys.argv[1:2] == ['batch']:
+        batch_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['serve']:
+        serve_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['bench']:
+        bench_main(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser(
         'seewav', description="Generate a nice mp4 animation from an audio file.")
     parser.add_argument("-r", "--rate", type=int, default=50, help="Video framerate.")
@@ -432,6 +3160,49 @@ def main():
                         type=parse_coords,
                         dest="center",
                         help="The center of the bars relative to the image.")
+    parser.add_argument("--renderer", choices=sorted(RENDERERS), default="cairo",
+                        help="Backend used to draw the frames. numpy does not require pycairo.")
+    parser.add_argument("--dedup", type=float, default=0.,
+                        help="Frames whose bars moved less than this are not rendered again. "
+                             "Default only skips exact duplicates.")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Render every frame, even when unchanged.")
+    parser.add_argument("--analysis-tolerance", type=float,
+                        help="Analyse the audio at a reduced sample rate if the envelope "
+                             "differs by less than this from the native rate (e.g. 0.02). "
+                             "By default the native rate is always used.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes used to render the frames.")
+    parser.add_argument("--cache-dir", type=Path, default=default_cache_dir(),
+                        help="Where to cache the analysis of audio files. "
+                             "Default is %(default)s.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not read or write the analysis cache.")
+    parser.add_argument("--segments", type=int, default=1,
+                        help="Split the video in this many chunks, rendered and encoded in "
+                             "parallel by the --jobs workers. Interrupted renders resume from "
+                             "the completed chunks.")
+    parser.add_argument("--metrics", type=Path,
+                        help="Write the timing of each stage and a summary of the frame "
+                             "latencies to this file, as JSON lines.")
+    parser.add_argument("--cprofile", type=Path,
+                        help="Save cProfile statistics of the render to this file.")
+    parser.add_argument("--frame-store", type=Path,
+                        help="Keep the bar heights of every frame in this memory mapped .npy "
+                             "file. Once it is complete, rendering the same audio again, e.g. "
+                             "with other encoder settings, skips the audio analysis. Frames "
+                             "are still drawn and encoded, use --segments to resume "
+                             "interrupted renders.")
+    parser.add_argument("-p", "--profile", choices=list(ENCODER_PROFILES), default="default",
+                        help="Encoder profile, trading encode speed for file size.")
+    parser.add_argument("--codec", help="Video codec, overrides the profile.")
+    parser.add_argument("--crf", type=float, help="Constant quality, overrides the profile.")
+    parser.add_argument("--bitrate", help="Target video bitrate (e.g. 4M), instead of a crf.")
+    parser.add_argument("--preset", help="Encoder preset, overrides the profile.")
+    parser.add_argument("--tune", help="Encoder tune (e.g. animation), overrides the profile.")
+    parser.add_argument("--gop", type=int, help="Keyframe interval in frames.")
+    parser.add_argument("--pix-fmt", help="Output pixel format, overrides the profile.")
+    parser.add_argument("--threads", type=int, help="Encoder threads, overrides the profile.")
     parser.add_argument("-s", "--seek", type=float, help="Seek to time in seconds in video.")
     parser.add_argument("-d", "--duration", type=float, help="Duration in seconds from seek time.")
     parser.add_argument("audio", type=Path, help='Path to audio file')
@@ -441,25 +3212,48 @@ def main():
                         default=Path('out.mp4'),
                         help='Path to output file. Default is ./out.mp4')
     args = parser.parse_args()
-    with tempfile.TemporaryDirectory() as tmp:
-        visualize(args.audio,
-                  Path(tmp),
-                  args.out,
-                  seek=args.seek,
-                  duration=args.duration,
-                  rate=args.rate,
-                  bars=args.bars,
-                  speed=args.speed,
-                  oversample=args.oversample,
-                  time=args.time,
-                  fg_color=args.color,
-                  fg_color2=args.color2,
-                  fg_opacity=args.opacity,
-                  bg_color=[1.] * 3 if bool(args.white) else args.background,
-                  bg_image=args.image,
-                  center=args.center,
-                  size=(args.width, args.height),
-                  stereo=args.stereo)
+    metrics = None
+    if args.metrics is not None:
+        metrics_file = open(args.metrics, 'w', encoding='utf-8')
+
+        def metrics(event):
+            metrics_file.write(json.dumps(event) + "\n")
+            metrics_file.flush()
+    visualize(args.audio,
+              None,
+              args.out,
+              seek=args.seek,
+              duration=args.duration,
+              rate=args.rate,
+              bars=args.bars,
+              speed=args.speed,
+              oversample=args.oversample,
+              time=args.time,
+              fg_color=args.color,
+              fg_color2=args.color2,
+              fg_opacity=args.opacity,
+              bg_color=[1.] * 3 if bool(args.white) else args.background,
+              bg_image=args.image,
+              center=args.center,
+              size=(args.width, args.height),
+              stereo=args.stereo,
+              renderer=args.renderer,
+              workers=args.jobs,
+              segments=args.segments,
+              profile=args.profile,
+              encoder_options={
+                  'codec': args.codec, 'crf': args.crf, 'bitrate': args.bitrate,
+                  'preset': args.preset, 'tune': args.tune, 'gop': args.gop,
+                  'pix_fmt': args.pix_fmt, 'threads': args.threads,
+              },
+              dedup=None if args.no_dedup else args.dedup,
+              analysis_tolerance=args.analysis_tolerance,
+              cache_dir=None if args.no_cache else args.cache_dir,
+              metrics=metrics,
+              cprofile=args.cprofile,
+              frame_store=args.frame_store)
+    if args.metrics is not None:
+        metrics_file.close()
 
 
 if __name__ == "__main__":
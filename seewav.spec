@@ -40,13 +40,16 @@ for dll in gtk_dlls:
         binaries.append((dll_path, '.'))
 
 # Add hidden imports
+# seewav imports its heavy dependencies lazily, by name (see _LazyModule),
+# and the GUI only imports QtMultimedia for the first preview.
 hidden_imports = [
     'cairo',
     'PIL',
+    'PIL.Image',
     'PIL._tkinter_finder',
     'numpy',
-    'ffmpeg',
-    'tqdm'
+    'tqdm',
+    'PyQt6.QtMultimedia'
 ]
 
 a = Analysis(
@@ -0,0 +1,867 @@
+import collections
+import http.client
+import io
+import json
+import math
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import seewav
+
+
+SIZE = (320, 180)
+FG_COLORS = ((.2, .2, .2), (.5, .3, .6))
+BG_COLOR = (1., 1., 1.)
+
+
+def random_envs(channels, bars, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.uniform(0, 1, bars) for _ in range(channels)]
+
+
+def frame(renderer, envs):
+    data = np.frombuffer(bytes(renderer.render(envs)), dtype=np.uint8)
+    return data.reshape(SIZE[1], SIZE[0], 4).astype(int)
+
+
+def stroke_bars(renderer, ctx, envs):
+    """
+    The drawing of `CairoRenderer` before bars were batched in a single path: two
+    butt-capped strokes per bar and channel.
+    """
+    K = len(envs)
+    T = len(envs[0])
+    width, pad, delta = seewav.bar_layout(T)
+    ctx.set_line_width(width)
+    for step in range(T):
+        for i in range(K):
+            half = 0.5 * envs[i][step] / K
+            midrule = (1 + 2 * i) / (2 * K)
+            ctx.set_source_rgba(*renderer.fg_colors[i], renderer.fg_opacity)
+            ctx.move_to(pad + step * delta, midrule - half)
+            ctx.line_to(pad + step * delta, midrule)
+            ctx.stroke()
+            ctx.set_source_rgba(*renderer.fg_colors[i], renderer.fg_opacity)
+            ctx.move_to(pad + step * delta, midrule)
+            ctx.line_to(pad + step * delta, midrule + 0.9 * half)
+            ctx.stroke()
+
+
+@pytest.mark.parametrize('channels', [1, 2])
+def test_bar_rectangles_match_strokes(channels):
+    envs = random_envs(channels, 50)
+    width, pad, delta = seewav.bar_layout(50)
+    for i, (left, top, height) in enumerate(seewav.bar_rectangles(envs)):
+        half = 0.5 * envs[i] / channels
+        midrule = (1 + 2 * i) / (2 * channels)
+        # A stroke of width `width` centered on x, from the top half to the bottom half.
+        assert np.allclose(left + width / 2, pad + np.arange(50) * delta)
+        assert np.allclose(top, midrule - half)
+        assert np.allclose(top + height, midrule + 0.9 * half)
+
+
+@pytest.mark.parametrize('channels', [1, 2])
+def test_batched_cairo_matches_strokes(channels, monkeypatch):
+    pytest.importorskip('cairo')
+    envs = random_envs(channels, 50)
+    batched = frame(seewav.CairoRenderer(FG_COLORS, 1., BG_COLOR, None, (.5, .5), SIZE), envs)
+    monkeypatch.setattr(seewav.CairoRenderer, '_draw_bars', stroke_bars)
+    strokes = frame(seewav.CairoRenderer(FG_COLORS, 1., BG_COLOR, None, (.5, .5), SIZE), envs)
+
+    diff = np.abs(batched - strokes).max(axis=-1)
+    # The rows holding a midrule, where the two halves of a stroke used to meet, are now
+    # covered by a single rectangle instead of being blended twice.
+    midrules = [int((1 + 2 * i) / (2 * channels) * SIZE[1]) for i in range(channels)]
+    outside = np.ones(SIZE[1], dtype=bool)
+    for row in midrules:
+        outside[max(0, row - 1):row + 2] = False
+    # Strokes go through cairo's polygon rasterizer, whose vertical precision is 1/15 of
+    # a pixel, while rectangles get their exact coverage.
+    assert diff[outside].max() <= 18
+    # Blending twice "over" with coverages c and 1 - c leaves at most 1/4 uncovered.
+    assert diff[~outside].max() <= 64 + 18
+
+
+@pytest.mark.parametrize('channels', [1, 2])
+@pytest.mark.parametrize('opacity', [1., .6])
+def test_numpy_matches_cairo(channels, opacity):
+    pytest.importorskip('cairo')
+    envs = random_envs(channels, 50)
+    cairo_frame = frame(seewav.CairoRenderer(FG_COLORS, opacity, BG_COLOR, None, (.5, .5), SIZE),
+                        envs)
+    numpy_frame = frame(seewav.NumpyRenderer(FG_COLORS, opacity, BG_COLOR, None, (.5, .5), SIZE),
+                        envs)
+    # Both compute the exact coverage of the rectangles, cairo with 8 bits of sub-pixel
+    # precision, so only rounding differs.
+    diff = np.abs(cairo_frame - numpy_frame)
+    assert diff.max() <= 4
+    assert diff.mean() < 0.1
+
+
+def exact_frame(envs, size, opacity):
+    """
+    Reference drawing, blending once each channel with the exact area of each pixel covered
+    by its bars.
+    """
+    width, height = size
+    out = np.empty((height, width, 4))
+    out[..., :3] = [seewav._color_to_byte(c) for c in BG_COLOR[::-1]]
+    out[..., 3] = 255
+    bar_width = seewav.bar_layout(len(envs[0]))[0]
+    col = np.arange(width)
+    row = np.arange(height)[:, None]
+    for color, (left, top, bar_height) in zip(FG_COLORS, seewav.bar_rectangles(envs)):
+        coverage = np.zeros((height, width))
+        for x, y, h in zip(left * width, top * height, bar_height * height):
+            cover_x = np.clip(np.minimum(x + bar_width * width, col + 1) - np.maximum(x, col), 0, 1)
+            cover_y = np.clip(np.minimum(y + h, row + 1) - np.maximum(y, row), 0, 1)
+            coverage += cover_y * cover_x
+        alpha = (np.minimum(coverage, 1) * opacity)[..., None]
+        fg = np.array([seewav._color_to_byte(c) for c in color[::-1]] + [255])
+        out = out * (1 - alpha) + fg * alpha
+    return np.floor(out + 0.5).astype(int)
+
+
+@pytest.mark.parametrize('size,bars', [((320, 180), 50), ((480, 270), 200), ((120, 90), 200)])
+@pytest.mark.parametrize('channels', [1, 2])
+@pytest.mark.parametrize('opacity', [1., .6])
+def test_numpy_matches_exact_coverage(size, bars, channels, opacity):
+    envs = random_envs(channels, bars)
+    renderer = seewav.NumpyRenderer(FG_COLORS, opacity, BG_COLOR, None, (.5, .5), size)
+    data = np.frombuffer(bytes(renderer.render(envs)), dtype=np.uint8)
+    # Bars less than a pixel apart must not blend the pixels they share twice.
+    diff = np.abs(data.reshape(size[1], size[0], 4).astype(int) - exact_frame(envs, size, opacity))
+    assert diff.max() <= 2
+
+
+def write_wav(path, wav, samplerate):
+    pcm = (np.clip(wav, -1, 1) * 32767).astype('<i2')
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes(pcm.tobytes())
+
+
+def whole_envelope_error(path, samplerate, bars=50, time=0.4, oversample=3):
+    results = []
+    for rate in [None, samplerate]:
+        envs, sr, _ = seewav.read_envelopes(path, bars, time, oversample, analysis_rate=rate)
+        stride = seewav.analysis_window(sr, time, bars, oversample)[1]
+        results.append((envs[0], np.arange(len(envs[0])) * stride / sr))
+    (full, full_time), (reduced, reduced_time) = results
+    return np.abs(full - np.interp(full_time, reduced_time, reduced)).mean()
+
+
+@pytest.mark.parametrize('kind', ['tone', 'sweep', 'noise'])
+def test_select_analysis_rate_within_tolerance(kind, tmp_path):
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        pytest.skip('ffmpeg is not installed')
+    samplerate, tolerance = 96000, 0.02
+    path = tmp_path / f'{kind}.wav'
+    if kind == 'tone':
+        t = np.arange(40 * samplerate) / samplerate
+        wav = 0.5 * np.sin(2 * math.pi * 220 * t) * (0.5 + 0.5 * np.sin(2 * math.pi * 0.3 * t))
+        write_wav(path, wav, samplerate)
+    else:
+        seewav.synthetic_audio(path, 40, kind, samplerate=samplerate, channels=1)
+    rate = seewav.select_analysis_rate(path, 50, 0.4, 3, tolerance=tolerance)
+    if kind == 'tone':
+        # Nothing above a few hundred hertz, the lowest rate is picked.
+        assert rate == seewav.analysis_samplerate(samplerate, 0.4, 50, 3) < samplerate
+    if rate is not None:
+        # The excerpts checked stand for the whole file.
+        assert whole_envelope_error(path, rate) <= tolerance
+
+
+def loop_envelope(wav, window, stride):
+    """
+    The per-window loop `envelope` used before it was vectorized.
+    """
+    wav = np.pad(wav, window // 2)
+    out = []
+    for off in range(0, len(wav) - window, stride):
+        out.append(np.maximum(wav[off:off + window], 0).mean())
+    return 1.9 * (seewav.sigmoid(2.5 * np.array(out)) - 0.5)
+
+
+@pytest.mark.parametrize('window,stride', [(1, 1), (8, 3), (100, 33), (441, 147), (1000, 1000)])
+def test_envelope_matches_loop(window, stride):
+    wav = np.random.default_rng(0).standard_normal(20000)
+    expected = loop_envelope(wav, window, stride)
+    assert np.allclose(seewav.envelope(wav, window, stride), expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('block', [1, 7, 100, 441, 4096, 20000, 50000])
+@pytest.mark.parametrize('window,stride', [(8, 3), (441, 147)])
+def test_streaming_envelope_matches_envelope(block, window, stride):
+    wav = (0.1 + np.random.default_rng(0).standard_normal(20000)).astype(np.float32)
+    extractor = seewav.StreamingEnvelope(window, stride)
+    for start in range(0, len(wav), block):
+        extractor.push(wav[start:start + block])
+    assert extractor.samples == len(wav)
+    expected = seewav.envelope(wav / wav.std(dtype=np.float64), window, stride)
+    assert np.allclose(extractor.finish(), expected, rtol=0, atol=1e-6)
+
+
+def loop_bar_heights(envs, frames, rate, sr, stride, bars, speed):
+    """
+    The per-frame computation of the bar heights done by `visualize` before it was
+    vectorized.
+    """
+    smooth = np.hanning(bars)
+    out = []
+    for idx in range(frames):
+        pos = (((idx / rate)) * sr) / stride / bars
+        off = int(pos)
+        loc = pos - off
+        denvs = []
+        for env in envs:
+            env1 = env[off * bars:(off + 1) * bars]
+            env2 = env[(off + 1) * bars:(off + 2) * bars]
+            maxvol = math.log10(1e-4 + env2.max()) * 10
+            speedup = np.clip(seewav.interpole(-6, 0.5, 0, 2, maxvol), 0.5, 2)
+            w = seewav.sigmoid(speed * speedup * (loc - 0.5))
+            denvs.append(((1 - w) * env1 + w * env2) * smooth)
+        out.append(denvs)
+    return np.array(out)
+
+
+@pytest.mark.parametrize('channels', [1, 2])
+@pytest.mark.parametrize('rate,chunk', [(24, 1024), (60, 7), (60, 1)])
+def test_iter_bar_heights_matches_loop(channels, rate, chunk):
+    sr, bars, speed = 44100, 50, 4
+    _, stride = seewav.analysis_window(sr, 0.4, bars, 3)
+    duration = 3.
+    rng = np.random.default_rng(0)
+    envs = [np.pad(rng.uniform(0, 0.95, int(duration * sr / stride)), (bars // 2, 2 * bars))
+            for _ in range(channels)]
+    frames = int(rate * duration)
+    heights = np.array(list(seewav.iter_bar_heights(envs, frames, rate, sr, stride, bars, speed,
+                                                    chunk=chunk)))
+    expected = loop_bar_heights(envs, frames, rate, sr, stride, bars, speed)
+    assert heights.shape == expected.shape == (frames, channels, bars)
+    assert np.allclose(heights, expected, rtol=0, atol=1e-12)
+    # Starting in the middle gives the same frames.
+    tail = list(seewav.iter_bar_heights(envs, frames, rate, sr, stride, bars, speed,
+                                        chunk=chunk, start=frames // 2))
+    assert np.allclose(tail, expected[frames // 2:], rtol=0, atol=1e-12)
+
+
+class GatedRenders:
+    """
+    Stands for `_run_batch_job` in the server tests: records the order in which jobs
+    start, and only completes them once `gate` is set, unless they are cancelled.
+    """
+
+    def __init__(self):
+        self.started = []
+        self.gate = threading.Event()
+
+    def __call__(self, job, cancel=None, **kwargs):
+        self.started.append(job['id'])
+        while not self.gate.wait(0.01):
+            if cancel.cancelled:
+                return {'id': job['id'], 'status': 'error', 'error': 'cancelled', 'elapsed': 0.}
+        return {'id': job['id'], 'status': 'ok', 'elapsed': 0.}
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(render_queue):
+        ready = queue.Queue()
+        thread = threading.Thread(target=seewav.serve, args=(render_queue,),
+                                  kwargs={'port': 0, 'on_ready': ready.put}, daemon=True)
+        thread.start()
+        server = ready.get(timeout=10)
+        servers.append((server, thread))
+        return server.server_address[1]
+
+    yield start
+    for server, thread in servers:
+        server.shutdown()
+        thread.join(10)
+
+
+@pytest.fixture
+def gated(monkeypatch):
+    renders = GatedRenders()
+    monkeypatch.setattr(seewav, '_run_batch_job', renders)
+    yield renders
+    renders.gate.set()
+
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request(method, path, body=None if body is None else json.dumps(body))
+    response = conn.getresponse()
+    data = json.loads(response.read())
+    conn.close()
+    return response.status, data, response
+
+
+def events(port, job_id, on_first=None):
+    """
+    Read the event stream of a job until the server closes it.
+    """
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', f'/jobs/{job_id}/events')
+    response = conn.getresponse()
+    assert response.status == 200
+    assert response.getheader('Content-Type') == 'application/x-ndjson'
+    out = []
+    for line in response:
+        out.append(json.loads(line))
+        if on_first is not None and len(out) == 1:
+            on_first()
+    conn.close()
+    return [event['event'] for event in out]
+
+
+def submit(port, job_id, priority=0):
+    return request(port, 'POST', '/jobs', {'id': job_id, 'audio': 'in.wav',
+                                           'out': f'{job_id}.mp4', 'priority': priority})
+
+
+def wait_started(renders, count):
+    for _ in range(1000):
+        if len(renders.started) >= count:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError(f"only {renders.started} started")
+
+
+def test_server_priority_order(gated, start_server):
+    port = start_server(seewav.RenderQueue(jobs=1))
+    assert submit(port, 'first')[0] == 202
+    # The single worker is busy, the next jobs wait in the queue.
+    wait_started(gated, 1)
+    for job_id, priority in [('low', 0), ('high', 5), ('mid', 1), ('high2', 5), ('low2', 0)]:
+        status, job, _ = submit(port, job_id, priority)
+        assert status == 202
+        assert job['status'] == 'queued'
+    gated.gate.set()
+    assert events(port, 'low2')[-1] == 'done'
+    # Highest priority first, then in submission order.
+    assert gated.started == ['first', 'high', 'high2', 'mid', 'low', 'low2']
+
+
+def test_server_full_queue(gated, start_server):
+    port = start_server(seewav.RenderQueue(jobs=1, max_queue=2))
+    submit(port, 'running')
+    wait_started(gated, 1)
+    assert submit(port, 'a')[0] == 202
+    assert submit(port, 'b')[0] == 202
+    status, data, response = submit(port, 'c')
+    assert status == 503
+    assert 'queue is full' in data['error']
+    assert response.getheader('Retry-After') == '5'
+    assert request(port, 'GET', '/health')[1]['queued'] == 2
+    assert request(port, 'GET', '/jobs/c')[0] == 404
+
+
+def test_server_delete_queued_job(gated, start_server):
+    port = start_server(seewav.RenderQueue(jobs=1))
+    submit(port, 'running')
+    wait_started(gated, 1)
+    submit(port, 'waiting')
+    status, job, _ = request(port, 'DELETE', '/jobs/waiting')
+    assert status == 200
+    assert job['status'] == 'cancelled'
+    assert request(port, 'GET', '/health')[1]['queued'] == 0
+    assert events(port, 'waiting') == ['queued', 'cancelled']
+    gated.gate.set()
+    assert events(port, 'running')[-1] == 'done'
+    # The cancelled job never reaches a worker.
+    assert gated.started == ['running']
+    assert request(port, 'DELETE', '/jobs/missing')[0] == 404
+
+
+def test_server_delete_running_job(gated, start_server):
+    port = start_server(seewav.RenderQueue(jobs=1))
+    submit(port, 'running')
+    wait_started(gated, 1)
+    received = events(port, 'running',
+                      on_first=lambda: request(port, 'DELETE', '/jobs/running'))
+    assert received == ['queued', 'started', 'cancelled']
+    assert request(port, 'GET', '/jobs/running')[1]['status'] == 'cancelled'
+
+
+@pytest.mark.parametrize('body,error', [
+    ({'audio': 'in.wav', 'out': 'out.mp4', 'colour': 'red'}, "unknown options ['colour']"),
+    ({'audio': 'in.wav', 'out': 'out.mp4', 'verbose': True}, "unknown options ['verbose']"),
+    ({'audio': 'in.wav'}, "invalid job"),
+    ({'audio': 'in.wav', 'out': 'out.mp4', 'priority': 'high'}, "invalid job"),
+    ([], "a job must be a JSON object"),
+])
+def test_server_rejects_invalid_jobs(gated, start_server, body, error):
+    port = start_server(seewav.RenderQueue(jobs=1))
+    status, data, _ = request(port, 'POST', '/jobs', body)
+    assert status == 400
+    assert error in data['error']
+    assert request(port, 'GET', '/jobs')[1] == []
+
+
+def test_server_events_stream_until_done(gated, start_server):
+    port = start_server(seewav.RenderQueue(jobs=1))
+    submit(port, 'job')
+    wait_started(gated, 1)
+    # The stream follows the job live, until it finishes.
+    assert events(port, 'job', on_first=gated.gate.set) == ['queued', 'started', 'done']
+    assert request(port, 'GET', '/jobs/job')[1]['result']['status'] == 'ok'
+
+
+def test_server_renders(tmp_path, start_server):
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        pytest.skip('ffmpeg is not installed')
+    audio = tmp_path / 'in.wav'
+    seewav.synthetic_audio(audio, 1., 'sweep')
+    port = start_server(seewav.RenderQueue(jobs=1))
+    status, job, _ = request(port, 'POST', '/jobs', {
+        'audio': str(audio), 'out': str(tmp_path / 'out.mp4'), 'renderer': 'numpy',
+        'size': [160, 90], 'rate': 10})
+    assert status == 202
+    received = events(port, job['id'])
+    assert received[0] == 'queued'
+    assert received[-1] == 'done'
+    assert 'frame' in received
+    assert (tmp_path / 'out.mp4').stat().st_size > 0
+
+
+def test_mark_duplicates():
+    rows = np.array([[0., 0.], [0., 0.], [.06, 0.], [.12, 0.], [.12, .05], [.5, .5]])
+    assert [dup for _, dup in seewav._mark_duplicates(rows, None)] == [False] * 6
+    assert [dup for _, dup in seewav._mark_duplicates(rows, 0)] == [
+        False, True, False, False, False, False]
+    # Compared to the last rendered frame, so slow motions cannot drift unrendered.
+    assert [dup for _, dup in seewav._mark_duplicates(rows, .1)] == [
+        False, True, True, False, True, False]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_render_frames_repeats_duplicates(workers):
+    envs = np.array(random_envs(2, 50))
+    heights = [envs, envs, envs * .5, envs * .5 + 1e-3, envs]
+    style = dict(fg_colors=FG_COLORS, fg_opacity=1., bg_color=BG_COLOR, bg_image=None,
+                 center=(.5, .5), size=SIZE)
+    stats = {}
+    frames = [bytes(data) for data in seewav.render_frames(
+        {'renderer': 'numpy', 'style': style}, heights, workers=workers, dedup=.01, stats=stats)]
+    assert stats['skipped'] == 2
+    renderer = seewav.NumpyRenderer(**style)
+    expected = [bytes(renderer.render(heights[index])) for index in [0, 0, 2, 2, 4]]
+    assert frames == expected
+
+
+def test_encoder_default_profile():
+    video_args, audio_args = seewav.encoder_args(seewav.encoder_settings())
+    # The historical settings of seewav.
+    assert video_args == ["-vcodec", "libx264", "-crf", "10", "-pix_fmt", "yuv420p",
+                          "-threads", "8", "-preset", "veryfast"]
+    assert audio_args == ["-c:a", "aac"]
+
+
+def test_encoder_overrides():
+    settings = seewav.encoder_settings('web', crf=30, preset=None, gop=48)
+    # Overrides win over the profile, None keeps the setting of the profile.
+    assert settings['crf'] == 30
+    assert settings['preset'] == 'medium'
+    assert settings['tune'] == 'animation'
+    video_args, audio_args = seewav.encoder_args(settings)
+    assert video_args[video_args.index("-g") + 1] == "48"
+    assert audio_args == ["-c:a", "aac", "-b:a", "128k"]
+    # The profiles themselves are left untouched.
+    assert seewav.ENCODER_PROFILES['web']['crf'] == 23
+
+
+def test_encoder_bitrate_replaces_crf():
+    video_args, _ = seewav.encoder_args(seewav.encoder_settings('archive', bitrate='4M'))
+    assert "-crf" not in video_args
+    assert video_args[video_args.index("-b:v") + 1] == "4M"
+    # Unless both are asked for, e.g. a capped constant quality.
+    video_args, _ = seewav.encoder_args(seewav.encoder_settings('archive', bitrate='4M', crf=20))
+    assert video_args[video_args.index("-crf") + 1] == "20"
+    assert "-b:v" in video_args
+
+
+def test_encoder_invalid_settings():
+    with pytest.raises(ValueError, match="Unknown encoder profile"):
+        seewav.encoder_settings('missing')
+    with pytest.raises(ValueError, match="Unknown encoder setting"):
+        seewav.encoder_settings('default', quality=3)
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    """
+    Replaces ffprobe, returns the list of the files probed, with an empty `read_info` cache.
+    """
+    probed = []
+
+    def probe(media):
+        probed.append(Path(media).name)
+        return {'format': {'size': os.path.getsize(media)}}
+
+    monkeypatch.setattr(seewav, '_probe', probe)
+    monkeypatch.setattr(seewav, '_info_cache', collections.OrderedDict())
+    return probed
+
+
+def test_read_info_invalidation(tmp_path, probes):
+    media = tmp_path / 'a.wav'
+    media.write_bytes(b'1234')
+    assert seewav.read_info(media) == {'format': {'size': 4}}
+    seewav.read_info(media)
+    assert probes == ['a.wav']
+    # A new size or modification time is a new file.
+    media.write_bytes(b'123456')
+    assert seewav.read_info(media) == {'format': {'size': 6}}
+    stat = media.stat()
+    os.utime(media, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    seewav.read_info(media)
+    assert probes == ['a.wav'] * 3
+    with pytest.raises(IOError):
+        seewav.read_info(tmp_path / 'missing.wav')
+
+
+def test_read_info_lru(tmp_path, probes, monkeypatch):
+    monkeypatch.setattr(seewav, '_INFO_CACHE_SIZE', 2)
+    for name in 'abc':
+        (tmp_path / f'{name}.wav').write_bytes(b'0')
+    for name in 'abac':
+        seewav.read_info(tmp_path / f'{name}.wav')
+    assert len(seewav._info_cache) == 2
+    # b was the least recently used when c came in.
+    seewav.read_info(tmp_path / 'a.wav')
+    seewav.read_info(tmp_path / 'b.wav')
+    assert probes == ['a.wav', 'b.wav', 'c.wav', 'b.wav']
+
+
+def test_read_info_disk_cache(tmp_path, probes):
+    cache_dir = tmp_path / 'cache'
+    medias = []
+    for name in 'abc':
+        medias.append(tmp_path / f'{name}.wav')
+        medias[-1].write_bytes(b'0')
+        seewav.read_info(medias[-1], cache_dir=cache_dir)
+    stored = sorted((cache_dir / 'probes').glob('*.json'))
+    assert len(stored) == 3
+    # Another process only finds them on disk.
+    seewav._info_cache.clear()
+    assert seewav.read_info(medias[0], cache_dir=cache_dir) == {'format': {'size': 1}}
+    assert probes == ['a.wav', 'b.wav', 'c.wav']
+    # Probes are evicted with the envelopes, least recently used first.
+    for age, path in enumerate(stored):
+        os.utime(path, (age, age))
+    seewav._evict(cache_dir, sum(path.stat().st_size for path in stored[1:]))
+    assert sorted((cache_dir / 'probes').glob('*.json')) == stored[1:]
+
+
+def test_cancel_token():
+    token = seewav.CancelToken()
+    token.check()
+    token.cancel()
+    token.cancel()
+    with pytest.raises(seewav.Cancelled):
+        token.check()
+    latency = token.latency
+    assert latency is not None and latency >= 0
+    # The latency is measured at the first check only.
+    with pytest.raises(seewav.Cancelled):
+        token.check()
+    assert token.latency == latency
+
+
+SLEEP = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+
+def test_run_process_kill():
+    token = seewav.CancelToken()
+    threading.Timer(0.2, token.cancel).start()
+    begin = time.monotonic()
+    with pytest.raises(seewav.Cancelled):
+        seewav._run_process(SLEEP, token)
+    assert time.monotonic() - begin < 10
+    # A process started once the token is cancelled is killed right away.
+    begin = time.monotonic()
+    with pytest.raises(seewav.Cancelled):
+        seewav._run_process(SLEEP, token, capture=True)
+    assert time.monotonic() - begin < 10
+
+
+def test_run_process():
+    command = [sys.executable, '-c', 'print("hello")']
+    assert seewav._run_process(command, capture=True).strip() == b'hello'
+    with pytest.raises(subprocess.CalledProcessError):
+        seewav._run_process([sys.executable, '-c', 'raise SystemExit(3)'], capture=True)
+
+
+def test_pipe_frames_cancel():
+    token = seewav.CancelToken()
+    written = []
+
+    def frames():
+        for index in range(1000):
+            if index == 5:
+                token.cancel()
+            yield b'\0' * 1024
+
+    command = [sys.executable, '-c', 'import sys; sys.stdin.buffer.read()']
+    with pytest.raises(seewav.Cancelled):
+        seewav._pipe_frames(command, frames(), on_frame=written.append, cancel=token)
+    assert written == list(range(5))
+
+
+def test_render_progress(monkeypatch):
+    clock = [0.]
+    monkeypatch.setattr(seewav, 'perf_counter', lambda: clock[0])
+    updates = []
+    progress = seewav.RenderProgress(
+        [('analysis', 10, 's'), ('frames', 100, 'frames'), ('encode', 100, 'frames')],
+        updates.append, costs={'analysis': 1., 'frames': .1, 'encode': .01})
+    # Before any measure, the costs per unit give the estimate.
+    assert progress.estimate() == (0., 21.)
+
+    clock[0] = 2.
+    progress.update('analysis', 5)
+    # 5 seconds decoded in 2, the 5 left take 2 more.
+    assert progress.estimate() == (2., 2. + 10. + 1.)
+    assert updates[-1]['throughput'] == 2.5
+    assert updates[-1]['percent'] == pytest.approx(100 * 2 / 15)
+
+    clock[0] = 4.
+    progress.update('frames', 0)
+    clock[0] = 5.
+    progress.update('frames', 20)
+    assert updates[-1]['stage'] == 'frames'
+    assert updates[-1]['eta'] == pytest.approx(80 / 20 + 1.)
+    assert updates[-1]['percent'] == pytest.approx(50.)
+    # Late updates of a completed stage are ignored.
+    progress.update('analysis', 10)
+    assert updates[-1]['stage'] == 'frames'
+
+    # A slow down raises the ETA, but the percentage never goes backward.
+    clock[0] = 50.
+    progress.update('frames', 21)
+    assert updates[-1]['eta'] > 100
+    assert updates[-1]['percent'] == pytest.approx(50.)
+
+    clock[0] = 60.
+    progress.finish()
+    assert updates[-1]['percent'] == 100.
+    assert updates[-1]['eta'] == 0.
+
+
+def test_render_progress_resumed(monkeypatch):
+    clock = [0.]
+    monkeypatch.setattr(seewav, 'perf_counter', lambda: clock[0])
+    progress = seewav.RenderProgress([('analysis', 1, 's'), ('frames', 100, 'frames')],
+                                     costs={'analysis': 0., 'frames': 1.})
+    # Frames done by a previous run do not count in the throughput.
+    progress.update('frames', 60)
+    clock[0] = 10.
+    progress.update('frames', 70)
+    assert progress.estimate()[1] == pytest.approx(30.)
+    progress.set_total('frames', 80)
+    assert progress.estimate()[1] == pytest.approx(10.)
+    with pytest.raises(ValueError):
+        progress.update('mux', 1)
+
+
+def test_parse_progress():
+    stream = io.BytesIO(
+        b"frame=10\nfps=0.0\nout_time_us=1500000\nprogress=continue\n"
+        b"not a value\nframe=20\nout_time_us=N/A\nprogress=end\n")
+    blocks = []
+    seewav._parse_progress(stream, blocks.append)
+    assert blocks == [
+        {'frame': '10', 'fps': '0.0', 'out_time_us': '1500000', 'progress': 'continue'},
+        {'frame': '20', 'out_time_us': 'N/A', 'progress': 'end'},
+    ]
+    assert seewav._progress_seconds(blocks[0]) == 1.5
+    assert seewav._progress_seconds(blocks[1]) == 0.
+    assert seewav._progress_seconds({'out_time_us': '-23220'}) == 0.
+    assert seewav._with_progress(['ffmpeg', '-y']) == [
+        'ffmpeg', '-nostats', '-progress', 'pipe:1', '-y']
+
+
+def store_envs(bars=50, seconds=3., sr=8000, stride=21):
+    rng = np.random.default_rng(0)
+    return [np.pad(rng.uniform(0, 0.95, int(seconds * sr / stride)), (bars // 2, 2 * bars))]
+
+
+def test_frame_store_resume(tmp_path):
+    path = tmp_path / 'store.npy'
+    params = {'audio': 'a.wav', 'bars': 50, 'seek': None}
+    args = (store_envs(), 30, 8000, 21, 50, 4)
+    expected = np.array(list(seewav.iter_bar_heights(*args[:1], 90, *args[1:])))
+    store = seewav.FrameStore.create(path, params, 90, 1, 50, 3.)
+    # Interrupted after 40 frames, with commits every 16.
+    heights = store.record(seewav.iter_bar_heights(*args[:1], 90, *args[1:]), every=16)
+    for _ in range(40):
+        next(heights)
+    heights.close()
+    store.close()
+
+    store = seewav.FrameStore.load(path, dict(params))
+    assert store.written == 40 and not store.complete
+    assert store.duration == 3.
+    resumed = np.array(list(store.iter_heights(*args)))
+    assert np.array_equal(resumed, expected)
+    assert store.complete
+    store.close()
+    # A complete store is read back as is.
+    store = seewav.FrameStore.load(path, params)
+    assert store.complete
+    assert np.array_equal(store.heights, expected)
+    store.close()
+
+
+def test_frame_store_invalidation(tmp_path):
+    path = tmp_path / 'store.npy'
+    params = {'audio': 'a.wav', 'bars': 50, 'seek': None}
+    store = seewav.FrameStore.create(path, params, 10, 1, 50, 1.)
+    store.close()
+    assert seewav.FrameStore.load(tmp_path / 'missing.npy', params) is None
+    # Made for another render.
+    assert seewav.FrameStore.load(path, dict(params, bars=60)) is None
+    assert seewav.FrameStore.load(path, dict(params, seek=1.)) is None
+    # Replaced by a store for other parameters.
+    store = seewav.FrameStore.create(path, dict(params, bars=60), 20, 1, 60, 2.)
+    store.close()
+    assert seewav.FrameStore.load(path, params) is None
+    assert seewav.FrameStore.load(path, dict(params, bars=60)).heights.shape == (20, 1, 60)
+    # Without its sidecar, the heights are not trusted.
+    seewav.FrameStore._sidecar(path).unlink()
+    assert seewav.FrameStore.load(path, dict(params, bars=60)) is None
+
+
+def test_visualize_reuses_frame_store(tmp_path, monkeypatch):
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        pytest.skip('ffmpeg is not installed')
+    audio = tmp_path / 'in.wav'
+    seewav.synthetic_audio(audio, 1., 'sweep')
+    store = tmp_path / 'store.npy'
+    options = dict(renderer='numpy', size=(160, 90), rate=10, frame_store=store, verbose=False)
+    seewav.visualize(audio, None, tmp_path / 'a.mp4', **options)
+    analysed = []
+    original = seewav.cached_envelopes
+    monkeypatch.setattr(seewav, 'cached_envelopes',
+                        lambda *args, **kwargs: analysed.append(1) or original(*args, **kwargs))
+    # Other colors and encoder settings only need the stored heights.
+    stats = seewav.visualize(audio, None, tmp_path / 'b.mp4', fg_color=(1, 0, 0),
+                             profile='draft', **options)
+    assert analysed == []
+    assert stats['frames'] == 10
+    # Other bars need another analysis, which replaces the store.
+    seewav.visualize(audio, None, tmp_path / 'c.mp4', bars=30, **options)
+    assert analysed == [1]
+    assert np.load(store).shape == (10, 1, 30)
+
+
+def test_cached_envelopes_read_only(tmp_path, monkeypatch):
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        pytest.skip('ffmpeg is not installed')
+    audio = tmp_path / 'in.wav'
+    seewav.synthetic_audio(audio, 1., 'noise')
+    cache_dir = tmp_path / 'cache'
+    envs, sr, samples = seewav.cached_envelopes(audio, 50, .4, 3, cache_dir=cache_dir)
+
+    def read_only(*args, **kwargs):
+        raise PermissionError("read-only file system")
+
+    monkeypatch.setattr(seewav.os, 'utime', read_only)
+    monkeypatch.setattr(seewav, 'read_envelopes', None)
+    # A hit never decodes the audio again, even if the entry cannot be touched.
+    cached, cached_sr, cached_samples = seewav.cached_envelopes(audio, 50, .4, 3,
+                                                                cache_dir=cache_dir)
+    assert (cached_sr, cached_samples) == (sr, samples)
+    assert np.array_equal(cached[0], envs[0])
+
+
+def test_calibrate(tmp_path, monkeypatch):
+    runs = []
+
+    def fake_visualize(audio, bg_image, out, rate, bars, size, **kwargs):
+        # Renders take 10 ms per frame, 1 ns per pixel and 20 µs per bar.
+        runs.append((bars, size))
+        clock[0] += 60 * (0.01 + 1e-9 * size[0] * size[1] + 2e-5 * bars)
+        return {'frames': 60}
+
+    clock = [0.]
+    monkeypatch.setattr(seewav.time, 'perf_counter', lambda: clock[0])
+    monkeypatch.setattr(seewav, 'visualize', fake_visualize)
+    calibration = seewav.calibrate(cache_dir=tmp_path)
+    assert runs == [(50, (480, 270)), (50, (960, 540)), (200, (480, 270))]
+    assert calibration == pytest.approx({'frame': 0.01, 'pixel': 1e-9, 'bar': 2e-5})
+    assert seewav.estimate_render_time(calibration, 10, 30, (1280, 720), 100) == \
+        pytest.approx(300 * (0.01 + 1e-9 * 1280 * 720 + 2e-5 * 100))
+    # The second calibration with the same arguments is read from the disk.
+    assert seewav.calibrate(cache_dir=tmp_path) == calibration
+    assert len(runs) == 3
+    seewav.calibrate(profile='draft', cache_dir=tmp_path)
+    assert len(runs) == 6
+
+
+def test_read_manifest(tmp_path):
+    folder = tmp_path / 'jobs'
+    folder.mkdir()
+    manifest = folder / 'manifest.jsonl'
+    manifest.write_text('\n'.join(json.dumps(job) for job in [
+        {'audio': 'a.wav', 'out': 'out/a.mp4', 'bg_image': 'bg.png', 'frame_store': 'a.npy',
+         'cache_dir': 'cache', 'cprofile': '/tmp/a.prof', 'bars': 30},
+        {'id': 'b', 'audio': 'b.wav', 'out': 'b.mp4', 'cache_dir': None},
+    ]) + '\n\n', encoding='utf-8')
+    first, second = seewav.read_manifest(manifest)
+    root = folder.resolve()
+    assert first == {'id': str(root / 'out/a.mp4'), 'audio': str(root / 'a.wav'),
+                     'out': str(root / 'out/a.mp4'), 'options': {
+                         'bg_image': str(root / 'bg.png'), 'frame_store': str(root / 'a.npy'),
+                         'cache_dir': str(root / 'cache'), 'cprofile': '/tmp/a.prof',
+                         'bars': 30}}
+    # None still disables the cache.
+    assert second['id'] == 'b'
+    assert second['options'] == {'cache_dir': None}
+
+
+@pytest.mark.parametrize('line,error', [
+    ({'audio': 'a.wav'}, "manifest.jsonl:1: invalid job"),
+    ({'audio': 'a.wav', 'out': 'a.mp4', 'workers': 2}, "cannot use 'workers'"),
+])
+def test_read_manifest_invalid(tmp_path, line, error):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text(json.dumps(line) + '\n', encoding='utf-8')
+    with pytest.raises(ValueError, match=error):
+        seewav.read_manifest(manifest)
+
+
+def test_segments_reuse_renderer(tmp_path, monkeypatch):
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        pytest.skip('ffmpeg is not installed')
+    audio = tmp_path / 'in.wav'
+    seewav.synthetic_audio(audio, 3., 'sweep')
+    created = []
+
+    class CountedRenderer(seewav.NumpyRenderer):
+        def __init__(self, *args, **kwargs):
+            created.append(1)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setitem(seewav.RENDERERS, 'numpy', CountedRenderer)
+    stats = seewav.visualize(audio, None, tmp_path / 'out.mp4', renderer='numpy', size=(160, 90),
+                             rate=10, segments=3, encoder_options={'gop': 10}, verbose=False)
+    assert stats['frames'] == 30
+    assert len(created) == 1
+    assert not (tmp_path / 'out.mp4.parts').exists()